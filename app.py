@@ -1,29 +1,1223 @@
-from flask import Flask, render_template, request, redirect, url_for, session, send_file, flash
+from flask import Blueprint, Flask, Response, current_app, render_template, request, redirect, url_for, session, send_file, flash, g, has_app_context, jsonify, make_response
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 import firebase_admin
-from firebase_admin import credentials, firestore, auth, storage
-from io import BytesIO
+from firebase_admin import credentials, firestore, storage
+from firebase_admin import auth as firebase_auth
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from collections import OrderedDict
+from functools import partial
+import contextvars
+import logging
 import os
 import ast
-from datetime import datetime
+import base64
+import bisect
+import csv
+import gzip
+import hashlib
+import hmac
+import io
+import json
+import threading
+import time
+import uuid
+import weakref
+from werkzeug.http import is_resource_modified
+from werkzeug.local import LocalProxy
+from datetime import datetime, timedelta
 from google.cloud.firestore_v1 import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
+from google.api_core.exceptions import NotFound
+from blob_cache import BlobDiskCache
+from firebase_scripts import BATCH_WRITE_LIMIT
+from jobs import JobQueue
+from uploads import SUMMARY_RECENT
+from rebuild_pdf_summaries import check_summaries
+from migrate_assigned_patients import migrate as migrate_assigned_patients
+from backfill_email_lower import backfill_email_lower
+from metrics import BackendStats, Instrumented, MetricsRegistry, current_request_stats, recording_to, server_timing
+
+logger = logging.getLogger(__name__)
+
+# All routes live on this blueprint; create_app registers it on a new app
+main = Blueprint('main', __name__)
+
+def default_config():
+    """Return the app configuration, read from the environment."""
+    return {
+        'SECRET_KEY': 'firebase secret key',  # Replace with a secure key
+        'FIREBASE_CREDENTIALS': os.environ.get('FIREBASE_CREDENTIALS', 'firebase credential file here'),
+        'FIREBASE_BUCKET': os.environ.get('FIREBASE_BUCKET', 'firebase bucket here'),  # Ensure this matches your Firebase project
+        # 'proxy' streams PDFs through the worker; 'signed_url' redirects to a short-lived V4 signed URL
+        'PDF_DOWNLOAD_MODE': os.environ.get('PDF_DOWNLOAD_MODE', 'proxy'),
+        'SIGNED_URL_TTL': int(os.environ.get('SIGNED_URL_TTL', 900)),  # seconds
+        'PDF_PAGE_SIZE': int(os.environ.get('PDF_PAGE_SIZE', 20)),
+        'ADMIN_PAGE_SIZE': int(os.environ.get('ADMIN_PAGE_SIZE', 50)),
+        # Optional local disk cache for proxied PDF downloads; disabled when PDF_CACHE_DIR is empty.
+        # The size cap applies per worker process, so a shared directory can grow to workers * max bytes.
+        'PDF_CACHE_DIR': os.environ.get('PDF_CACHE_DIR', ''),
+        'PDF_CACHE_MAX_BYTES': int(os.environ.get('PDF_CACHE_MAX_BYTES', 1024 ** 3)),
+        'PDF_METADATA_TTL': int(os.environ.get('PDF_METADATA_TTL', 30)),  # seconds
+        # Add a Server-Timing header with per-service backend time to every response
+        'SERVER_TIMING': os.environ.get('SERVER_TIMING', '').lower() in ('1', 'true', 'yes'),
+        # /metrics requires an 'Authorization: Bearer <token>' header; it is disabled while this is empty
+        'METRICS_TOKEN': os.environ.get('METRICS_TOKEN', ''),
+        # SQLite file holding the background job queue, and worker threads per process
+        'JOB_DB_PATH': os.environ.get('JOB_DB_PATH', 'jobs.sqlite3'),
+        'JOB_WORKERS': int(os.environ.get('JOB_WORKERS', 2)),
+    }
+
+class FirebaseClients:
+    """The Firestore client, Storage bucket and Auth client the app talks to.
+
+    Clients are created on first use in each process by the factory that
+    create_app configures. A server that builds the app and then forks its
+    workers (gunicorn --preload) therefore never shares gRPC channels or HTTP
+    sessions between processes: reset() runs in every forked child.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.factory = None
+        self.reset()
+
+    def configure(self, factory):
+        """Set the function returning (db_client, storage_bucket, auth_client); clients are created lazily."""
+        with self.lock:
+            self.factory = factory
+            self.reset()
+
+    def reset(self):
+        self._db = self._bucket = self._auth = None
+
+    def _ensure(self):
+        if self._db is None:
+            with self.lock:
+                if self._db is None:
+                    db_client, storage_bucket, auth_client = self.factory()
+                    # Clients are wrapped so every backend call is counted per request (see metrics.py)
+                    self._bucket = Instrumented(storage_bucket, 'storage')
+                    self._auth = Instrumented(auth_client, 'auth')
+                    self._db = Instrumented(db_client, 'firestore')
+
+    @property
+    def db(self):
+        self._ensure()
+        return self._db
+
+    @property
+    def bucket(self):
+        self._ensure()
+        return self._bucket
+
+    @property
+    def auth(self):
+        self._ensure()
+        return self._auth
+
+# Each app keeps its clients and caches in app.extensions; these names resolve
+# to the current app's, so routes, jobs and pool tasks use them directly.
+db = LocalProxy(lambda: current_app.extensions['firebase'].db)
+bucket = LocalProxy(lambda: current_app.extensions['firebase'].bucket)
+auth = LocalProxy(lambda: current_app.extensions['firebase'].auth)
+
+# Apps created in this process, so a forked child can reset their clients
+apps = weakref.WeakSet()
+
+def get_firebase_app(credentials_path, bucket_name):
+    """Return this process's Firebase app, initializing it on first use.
+
+    Each process gets its own named app, so the clients created from it are
+    never inherited from a parent process.
+    """
+    name = f'medic-{os.getpid()}'
+    try:
+        return firebase_admin.get_app(name)
+    except ValueError:
+        cred = credentials.Certificate(credentials_path)
+        return firebase_admin.initialize_app(cred, {'storageBucket': bucket_name}, name=name)
+
+# Per-endpoint latency and backend usage, exposed at /metrics
+request_metrics = LocalProxy(lambda: current_app.extensions['request_metrics'])
+
+@main.before_app_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.backend_stats = BackendStats()
+    current_request_stats.set(g.backend_stats)
+
+@main.after_app_request
+def record_request_metrics(response):
+    if 'request_started' in g:
+        elapsed = time.perf_counter() - g.request_started
+        request_metrics.observe_request(request.endpoint or 'unknown', request.method,
+                                        response.status_code, elapsed, g.backend_stats)
+        if current_app.config['SERVER_TIMING']:
+            response.headers['Server-Timing'] = server_timing(elapsed, g.backend_stats)
+    return response
+
+@main.teardown_app_request
+def reset_request_metrics(exc):
+    current_request_stats.set(None)
+
+@main.before_app_request
+def start_job_workers():
+    # Workers start with the first request in each process, so jobs left queued by a restart get run
+    current_app.extensions['jobs'].start()
+
+# Cache-Control for successful responses, by endpoint. Patient data may only be
+# kept in the browser's private cache. Dashboards must be revalidated, which
+# usually costs one document read and a 304; a PDF's bytes never change for a
+# given ETag, so a downloaded copy can be reused for a minute. Everything else,
+# including redirects and error pages, is not stored at all.
+CACHE_CONTROL = {
+    'main.patient_dashboard': 'private, no-cache',
+    'main.view_patient_pdfs': 'private, no-cache',
+    'main.download_pdf': 'private, max-age=60',
+}
+# HTML responses at least this large are gzipped for clients that accept it
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_LEVEL = 6
+
+@main.after_app_request
+def set_cache_control(response):
+    if request.endpoint == 'static':
+        return response
+    policy = CACHE_CONTROL.get(request.endpoint)
+    if policy and (response.status_code < 300 or response.status_code == 304):
+        response.headers['Cache-Control'] = policy
+    elif 'Cache-Control' not in response.headers:
+        response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@main.after_app_request
+def compress_html(response):
+    if (response.mimetype != 'text/html' or response.status_code != 200 or response.direct_passthrough
+            or response.is_streamed or 'Content-Encoding' in response.headers
+            or not request.accept_encodings.quality('gzip')):
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(data, COMPRESS_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+def not_modified(etag, last_modified=None, weak=False):
+    """Return a 304 response if the request's If-None-Match or If-Modified-Since still matches, else None.
+
+    A page with flashed messages waiting to be shown is never answered with a 304.
+    """
+    if '_flashes' in session:
+        return None
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+    response = Response(status=304)
+    response.set_etag(etag, weak=weak)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+# User record cache. Records are memoized per request on flask.g and kept in a
+# process-wide TTL+LRU cache. Other workers can hold a stale record for at most
+# USER_CACHE_TTL seconds; writes in this process invalidate it immediately.
+USER_CACHE_TTL = 60
+USER_CACHE_SIZE = 1024
+
+class TTLCache:
+    """Thread-safe TTL+LRU cache with hit/miss counters."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the cached value for key, or None if it is missing or expired."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+user_cache = LocalProxy(lambda: current_app.extensions['user_cache'])
+
+def request_user_records():
+    """Return the per-request memo of user records, or None outside a request."""
+    if not has_app_context():
+        return None
+    return g.setdefault('user_records', {})
+
+def invalidate_users(*user_ids):
+    """Drop user records from both the request memo and the process-wide cache after a write."""
+    user_cache.invalidate(*user_ids)
+    records = request_user_records()
+    if records is not None:
+        for user_id in user_ids:
+            records.pop(user_id, None)
+
+# Independent backend calls are issued concurrently on a shared pool, so a
+# request waits for the slowest call rather than the sum of them. Tasks run in
+# a copy of the submitting context: they see the current app and request, and
+# their calls are counted against the request (see metrics.py). Calls made
+# from a task that is already on the pool run inline, so the pool never waits
+# on itself.
+BACKEND_WORKERS = 16
+backend_pool = ThreadPoolExecutor(max_workers=BACKEND_WORKERS)
+in_backend_pool = contextvars.ContextVar('in_backend_pool', default=False)
+
+def run_pool_task(fn, args):
+    in_backend_pool.set(True)
+    return fn(*args)
+
+def submit(fn, *args):
+    """Start fn(*args) on the backend pool and return its Future."""
+    if in_backend_pool.get():
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+    return backend_pool.submit(contextvars.copy_context().run, run_pool_task, fn, args)
+
+def run_concurrently(*calls):
+    """Run zero-argument callables concurrently and return their results in order.
+
+    The first call runs on the calling thread. If any call raises, the first
+    exception is re-raised once all of them have finished.
+    """
+    futures = [submit(call) for call in calls[1:]]
+    try:
+        results = [calls[0]()] if calls else []
+    finally:
+        wait(futures)
+    return results + [future.result() for future in futures]
+
+# Batched user lookups: IDs are resolved in chunks of USER_BATCH_SIZE with one
+# get_all round trip per chunk, and chunks are fetched concurrently.
+USER_BATCH_SIZE = 100
+
+def get_users(user_ids, cached=True):
+    """Fetch user documents for a list of IDs using chunked batch reads.
+
+    Returns a list of user dicts in the same order as user_ids, with None in
+    place of any user that does not exist. With cached=True, records are served
+    from the request memo and the user cache where possible; pass cached=False
+    when the caller is about to write based on the result.
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return []
+
+    found = {}
+    records = request_user_records() if cached else None
+    unique_ids = []
+    for user_id in dict.fromkeys(user_ids):
+        if records is not None and user_id in records:
+            found[user_id] = records[user_id]
+            continue
+        user_data = user_cache.get(user_id) if cached else None
+        if user_data is not None:
+            found[user_id] = user_data
+        else:
+            unique_ids.append(user_id)
+
+    chunks = [unique_ids[i:i + USER_BATCH_SIZE] for i in range(0, len(unique_ids), USER_BATCH_SIZE)]
+
+    def fetch_chunk(chunk):
+        refs = [db.collection('users').document(user_id) for user_id in chunk]
+        return {doc.id: doc.to_dict() for doc in db.get_all(refs) if doc.exists}
+
+    # get_all returns documents in arbitrary order, so results are keyed by ID
+    fetched = {}
+    for chunk_result in run_concurrently(*(partial(fetch_chunk, chunk) for chunk in chunks)):
+        fetched.update(chunk_result)
+
+    for user_id, user_data in fetched.items():
+        user_cache.set(user_id, user_data)
+    found.update(fetched)
+    if records is not None:
+        records.update(found)
+
+    return [found.get(user_id) for user_id in user_ids]
+
+# Firestore rejects write batches with more than BATCH_WRITE_LIMIT operations.
+# Batches are committed concurrently, so writes to the same document must
+# commute (e.g. ArrayUnion/ArrayRemove transforms).
+def batch_update(updates):
+    """Apply a list of (document_ref, data) updates in as few write batches as possible."""
+    batches = []
+    for i in range(0, len(updates), BATCH_WRITE_LIMIT):
+        batch = db.batch()
+        for ref, data in updates[i:i + BATCH_WRITE_LIMIT]:
+            batch.update(ref, data)
+        batches.append(batch)
+    run_concurrently(*(batch.commit for batch in batches))
+
+def batch_set(documents):
+    """Create or overwrite a list of (document_ref, data) documents in as few write batches as possible."""
+    batches = []
+    for i in range(0, len(documents), BATCH_WRITE_LIMIT):
+        batch = db.batch()
+        for ref, data in documents[i:i + BATCH_WRITE_LIMIT]:
+            batch.set(ref, data)
+        batches.append(batch)
+    run_concurrently(*(batch.commit for batch in batches))
+
+def parse_assigned_patients(value):
+    """Return a doctor's assigned patient IDs as a list.
+
+    'assigned_patients' is a native array, but documents that have not been
+    migrated yet still hold the old Python-repr string.
+    """
+    if isinstance(value, str):
+        return ast.literal_eval(value)
+    return list(value or [])
+
+def assigned_patients_update(current_value, patient_ids, action):
+    """Build the 'assigned_patients' update value for assigning or unassigning patients.
+
+    Native arrays are changed with atomic ArrayUnion/ArrayRemove transforms so
+    concurrent updates cannot overwrite each other. Legacy string values are
+    rewritten in full as a native array.
+    """
+    if isinstance(current_value, str):
+        assigned_patients = parse_assigned_patients(current_value)
+        for patient_id in patient_ids:
+            if action == 'assign' and patient_id not in assigned_patients:
+                assigned_patients.append(patient_id)
+            elif action == 'unassign' and patient_id in assigned_patients:
+                assigned_patients.remove(patient_id)
+        return assigned_patients
+
+    if action == 'assign':
+        return firestore.ArrayUnion(list(patient_ids))
+    return firestore.ArrayRemove(list(patient_ids))
+
+# Doctor/patient assignments are indexed in both directions: doctors hold
+# 'assigned_patients' and patients hold 'assigned_doctors'. Both sides are
+# written in the same transaction so the index never drifts.
+@firestore.transactional
+def update_assignment(transaction, doctor_id, patient_id, action):
+    """Assign or unassign a patient to a doctor, updating both documents atomically.
+
+    Like bulk_assign, the doctor must be a user with the 'doctor' role and
+    an assigned patient one with the 'patient' role. A patient ID that no
+    longer belongs to a patient can still be unassigned. Returns one of
+    'doctor_not_found', 'patient_not_found', 'assigned', 'already_assigned',
+    'unassigned' or 'not_assigned'.
+    """
+    doctor_ref = db.collection('users').document(doctor_id)
+    patient_ref = db.collection('users').document(patient_id)
+    snapshots = {doc.id: doc for doc in transaction.get_all([doctor_ref, patient_ref])}
+    doctor_data = snapshots[doctor_id].to_dict() if doctor_id in snapshots and snapshots[doctor_id].exists else None
+    patient_data = snapshots[patient_id].to_dict() if patient_id in snapshots and snapshots[patient_id].exists else None
+    is_patient = patient_data is not None and patient_data.get('role') == 'patient'
+
+    if doctor_data is None or doctor_data.get('role') != 'doctor':
+        return 'doctor_not_found'
+    if action == 'assign' and not is_patient:
+        return 'patient_not_found'
+
+    current_value = doctor_data.get('assigned_patients', [])
+    assigned_patients = parse_assigned_patients(current_value)
+
+    if action == 'assign':
+        if patient_id in assigned_patients:
+            return 'already_assigned'
+        transaction.update(doctor_ref, {'assigned_patients': assigned_patients_update(current_value, [patient_id], action)})
+        transaction.update(patient_ref, {'assigned_doctors': firestore.ArrayUnion([doctor_id])})
+        return 'assigned'
+
+    if patient_id not in assigned_patients:
+        return 'not_assigned'
+    transaction.update(doctor_ref, {'assigned_patients': assigned_patients_update(current_value, [patient_id], action)})
+    if is_patient:
+        transaction.update(patient_ref, {'assigned_doctors': firestore.ArrayRemove([doctor_id])})
+    return 'unassigned'
+
+# Access control: each doctor's assigned patients are cached as a frozenset, so
+# checking whether a doctor may see a patient's PDFs is an in-memory set lookup.
+# Assignment writes in this process drop the doctor's entry immediately; other
+# workers see a change within ASSIGNMENT_CACHE_TTL seconds.
+ASSIGNMENT_CACHE_TTL = 60
+ASSIGNMENT_CACHE_SIZE = 1024
+
+assignment_cache = LocalProxy(lambda: current_app.extensions['assignment_cache'])
+
+def get_assigned_patient_ids(doctor_id):
+    """Return the set of IDs of the patients assigned to a doctor (empty if the doctor does not exist)."""
+    patient_ids = assignment_cache.get(doctor_id)
+    if patient_ids is None:
+        # Read past the user cache, so an entry is never older than ASSIGNMENT_CACHE_TTL
+        doctor_data, = get_users([doctor_id], cached=False)
+        patient_ids = frozenset(parse_assigned_patients(doctor_data.get('assigned_patients', []))) if doctor_data else frozenset()
+        assignment_cache.set(doctor_id, patient_ids)
+    return patient_ids
+
+def doctor_can_access(doctor_id, patient_id):
+    """Whether patient_id is assigned to doctor_id."""
+    return patient_id in get_assigned_patient_ids(doctor_id)
+
+def invalidate_assignments(*doctor_ids):
+    """Drop cached assigned-patient sets after an assignment write."""
+    assignment_cache.invalidate(*doctor_ids)
+
+def get_patient_doctor_ids(patient_id, patient_data=None):
+    """Return the IDs of the doctors a patient is assigned to.
+
+    The patient's 'assigned_doctors' index is only complete once
+    migrate_assigned_patients.py has set 'doctors_indexed' on the record (new
+    patients start with it set). Until then the doctors are searched instead,
+    matching both native arrays and legacy string 'assigned_patients' fields.
+    """
+    if patient_data is None:
+        patient_data, = get_users([patient_id])
+        if not patient_data:
+            return []
+
+    if patient_data.get('doctors_indexed'):
+        return list(patient_data.get('assigned_doctors', []))
+
+    users = db.collection('users')
+    doctor_ids = {doc.id for doc in users.where(filter=FieldFilter('assigned_patients', 'array_contains', patient_id))
+                  .select([]).stream()}
+    # Inequality filters only match values of the same type, so this finds exactly the string fields
+    legacy = users.where(filter=FieldFilter('assigned_patients', '>=', '')).select(['assigned_patients']).stream()
+    doctor_ids.update(doc.id for doc in legacy if patient_id in parse_assigned_patients(doc.get('assigned_patients')))
+    return sorted(doctor_ids)
+
+# PDFs are streamed from Storage in fixed-size chunks so memory per download
+# stays constant regardless of file size.
+PDF_CHUNK_SIZE = 256 * 1024
+
+def stream_blob(blob, start, end, registry, endpoint):
+    """Yield the bytes of blob in [start, end) in PDF_CHUNK_SIZE pieces.
+
+    The body is sent after the request's metrics are recorded and its context
+    is gone, so the Storage reads are counted here and added to endpoint's
+    totals in registry once the stream ends.
+    """
+    stats = BackendStats()
+    try:
+        with recording_to(stats):
+            reader = blob.open('rb', chunk_size=PDF_CHUNK_SIZE)
+        with reader:
+            reader.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                with recording_to(stats):
+                    chunk = reader.read(min(PDF_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+    finally:
+        registry.observe_backend(endpoint, stats)
+
+# Blob metadata (generation and size) is cached briefly so a cached PDF can be
+# served without a Storage round trip; a new generation changes the cache key.
+# Both caches are created per app by create_app.
+BLOB_METADATA_CACHE_SIZE = 4096
+
+def get_blob_metadata(pdf_file_path):
+    """Return the blob at pdf_file_path with its metadata loaded, or None if it does not exist."""
+    blob_metadata_cache = current_app.extensions['blob_metadata_cache']
+    blob = blob_metadata_cache.get(pdf_file_path)
+    if blob is None:
+        blob = bucket.get_blob(pdf_file_path)
+        if blob is not None:
+            blob_metadata_cache.set(pdf_file_path, blob)
+    return blob
+
+def pdf_etag(blob):
+    """Return the strong ETag of a PDF: its blob's generation and MD5, which change whenever its bytes do."""
+    return f'{blob.generation}-{blob.md5_hash}'
+
+def range_is_current(etag, last_modified):
+    """Whether a Range request's If-Range validator, if it has one, still matches the resource."""
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return last_modified is not None and last_modified.replace(microsecond=0) <= if_range.date
+    return True
+
+def send_blob(blob, download_name):
+    """Build a streaming PDF response for a Storage blob, honouring single-range Range requests.
+
+    The blob's metadata must already be loaded (e.g. via bucket.get_blob) so its size is known.
+    """
+    size = blob.size
+    start, end, status = 0, size, 200
+    etag = pdf_etag(blob)
+
+    # Multi-range requests are answered with the full body, which RFC 9110 allows
+    byte_range = request.range
+    if byte_range is not None and len(byte_range.ranges) == 1 and range_is_current(etag, blob.updated):
+        satisfiable = byte_range.range_for_length(size)
+        if satisfiable is None:
+            return Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+        start, end = satisfiable
+        status = 206
+
+    body = stream_blob(blob, start, end, request_metrics._get_current_object(), request.endpoint or 'unknown')
+    response = Response(body, status=status, mimetype='application/pdf', direct_passthrough=True)
+    response.headers['Content-Length'] = str(end - start)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    response.set_etag(etag)
+    response.last_modified = blob.updated
+    if status == 206:
+        response.headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+    return response
+
+# Signed URLs are cached per (pdf_id, user) and dropped SIGNED_URL_EXPIRY_MARGIN
+# seconds before they expire, so a redirect never hands out an almost-dead URL.
+SIGNED_URL_EXPIRY_MARGIN = 60
+SIGNED_URL_CACHE_SIZE = 4096
+
+def get_signed_pdf_url(pdf_id, user_id, pdf_file_path, download_name):
+    """Return a short-lived V4 signed download URL for a PDF, or None if one cannot be signed."""
+    signed_url_cache = current_app.extensions['signed_url_cache']
+    cache_key = (pdf_id, user_id)
+    signed_url = signed_url_cache.get(cache_key)
+    if signed_url is not None:
+        return signed_url
+
+    filename = download_name.replace('"', '')
+    try:
+        signed_url = bucket.blob(pdf_file_path).generate_signed_url(
+            version='v4',
+            expiration=timedelta(seconds=current_app.config['SIGNED_URL_TTL']),
+            method='GET',
+            response_type='application/pdf',
+            response_disposition=f'attachment; filename="{filename}"'
+        )
+    except Exception:
+        logger.exception("Error signing PDF URL")
+        return None
+
+    signed_url_cache.set(cache_key, signed_url)
+    return signed_url
+
+# Keyset pagination: pages are fetched with start_after on the ordering fields of
+# the last row seen, so each page costs page_size + 1 reads however deep it is.
+DOCUMENT_ID = FieldPath.document_id()
 
-# Initialize Flask app
-app = Flask(__name__)
-app.config['SECRET_KEY'] = 'firebase secret key'  # Replace with a secure key
+def encode_cursor(values):
+    """Encode keyset cursor values (strings or datetimes) as an opaque URL-safe token."""
+    payload = [['t', value.isoformat()] if isinstance(value, datetime) else ['s', value] for value in values]
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
 
-# Initialize Flask-Login
-login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'login'
+def decode_cursor(token):
+    """Decode a token produced by encode_cursor back into cursor values, or return None if it is malformed."""
+    try:
+        values = []
+        for kind, value in json.loads(base64.urlsafe_b64decode(token.encode())):
+            if not isinstance(value, str):
+                raise TypeError(f'cursor value {value!r} is not a string')
+            values.append(datetime.fromisoformat(value) if kind == 't' else value)
+        return values
+    except (ValueError, TypeError):
+        # binascii.Error, json.JSONDecodeError and UnicodeDecodeError are all ValueErrors
+        return None
+
+def get_page(query, order_by, page_size, after=None, before=None):
+    """Fetch one page of a keyset-paginated query.
+
+    order_by is a list of (field, direction) pairs ending with DOCUMENT_ID so
+    that rows are totally ordered. Pass the 'after' cursor to move forward or the
+    'before' cursor to move back. Returns (documents, prev_cursor, next_cursor).
+    A malformed or tampered cursor is ignored, so the first page is returned.
+    """
+    cursor = before if before is not None else after
+    values = decode_cursor(cursor) if cursor is not None else None
+    if values is None or len(values) != len(order_by):
+        after = before = None
+    backwards = before is not None
+    for field, direction in order_by:
+        if backwards:
+            direction = firestore.Query.ASCENDING if direction == firestore.Query.DESCENDING else firestore.Query.DESCENDING
+        query = query.order_by(field, direction=direction)
+
+    if after is not None or before is not None:
+        query = query.start_after(dict(zip([field for field, _ in order_by], values)))
+
+    docs = list(query.limit(page_size + 1).stream())
+    has_more = len(docs) > page_size
+    docs = docs[:page_size]
+    if backwards:
+        docs.reverse()
+    if not docs:
+        return [], None, None
+
+    def cursor_for(doc):
+        return encode_cursor([doc.id if field == DOCUMENT_ID else doc.get(field) for field, _ in order_by])
+
+    if backwards:
+        return docs, cursor_for(docs[0]) if has_more else None, cursor_for(docs[-1])
+    return docs, cursor_for(docs[0]) if after else None, cursor_for(docs[-1]) if has_more else None
+
+def get_pdf_summary(patient_id):
+    """Return the patient's summary document (see uploads.py) as a dict, or None if they have none."""
+    summary = db.collection('pdf_summaries').document(patient_id).get()
+    return summary.to_dict() if summary.exists else None
+
+def pdf_page_etag(summary):
+    """Return the ETag of the current page of a patient's PDFs, or None if the patient has no summary.
+
+    Pages only change when the patient's report count or latest upload does,
+    so a cached page can be validated with one read of the summary document.
+    The ETag is weak because the HTML may be sent compressed.
+    """
+    if summary is None:
+        return None
+    latest_upload = summary['latest_upload']
+    key = [current_user.id, current_user.email, request.full_path,
+           summary['count'], latest_upload.isoformat() if latest_upload else None]
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()[:32]
+
+def get_summary_page(summary, page_size):
+    """Return (pdf_list, prev_cursor, next_cursor) for the first page from a patient's summary.
+
+    Returns None if the summary holds too few entries for a page.
+    """
+    recent = summary['recent'][:page_size]
+    if len(recent) < min(summary['count'], page_size):
+        return None
+
+    pdf_list = [{'id': entry['id'], 'pdf_url': entry['pdf_url'], 'upload_date': entry['upload_date'], 'message': None}
+                for entry in recent]
+    next_cursor = None
+    if summary['count'] > len(recent):
+        next_cursor = encode_cursor([recent[-1]['upload_date'], recent[-1]['id']])
+    return pdf_list, None, next_cursor
+
+def get_pdf_page(patient_id, summary, after=None, before=None):
+    """Return (pdf_list, prev_cursor, next_cursor) for one page of a patient's PDFs, newest first.
+
+    summary is the patient's summary from get_pdf_summary. The first page
+    comes from it; later pages, and patients without a summary, query 'pdfs'.
+    """
+    page_size = current_app.config['PDF_PAGE_SIZE']
+    if not after and not before and summary is not None and page_size <= SUMMARY_RECENT:
+        page = get_summary_page(summary, page_size)
+        if page is not None:
+            return page
+
+    query = (db.collection('pdfs')
+             .where(filter=FieldFilter('patient_id', '==', patient_id))
+             .select(['pdf_url', 'upload_date']))
+    order_by = [('upload_date', firestore.Query.DESCENDING), (DOCUMENT_ID, firestore.Query.DESCENDING)]
+    docs, prev_cursor, next_cursor = get_page(query, order_by, page_size, after, before)
+
+    pdf_list = []
+    for pdf in docs:
+        pdf_data = pdf.to_dict()
+        pdf_list.append({
+            'id': pdf.id,
+            'pdf_url': pdf_data['pdf_url'],  # URL pointing to the PDF in Firebase Storage
+            'upload_date': pdf_data['upload_date'],  # Use the string value directly
+            'message': None
+        })
+    return pdf_list, prev_cursor, next_cursor
+
+# Roles listed on the admin dashboard. 'in' is an equality filter, so unlike
+# role != 'admin' it can be combined with ordering and range filters on email_lower.
+LISTED_ROLES = ['doctor', 'patient']
+
+def get_user_page(role=None, email_prefix=None, after=None, before=None):
+    """Return (user_list, prev_cursor, next_cursor) for one page of non-admin users ordered by email.
+
+    The prefix search is a case-insensitive range query on 'email_lower', the
+    lowercased copy of 'email' that every user write stores alongside it
+    (backfill_email_lower.py adds it to older documents).
+    """
+    query = db.collection('users')
+    if role in LISTED_ROLES:
+        query = query.where(filter=FieldFilter('role', '==', role))
+    else:
+        query = query.where(filter=FieldFilter('role', 'in', LISTED_ROLES))
+
+    if email_prefix:
+        email_prefix = email_prefix.strip().lower()
+        query = (query.where(filter=FieldFilter('email_lower', '>=', email_prefix))
+                      .where(filter=FieldFilter('email_lower', '<', email_prefix + '\uf8ff')))
+
+    order_by = [('email_lower', firestore.Query.ASCENDING), (DOCUMENT_ID, firestore.Query.ASCENDING)]
+    docs, prev_cursor, next_cursor = get_page(query.select(['email', 'email_lower', 'role']), order_by,
+                                              current_app.config['ADMIN_PAGE_SIZE'], after, before)
+
+    user_list = []
+    for doc in docs:
+        user_data = doc.to_dict()
+        user_list.append({'id': doc.id, 'email': user_data['email'], 'role': user_data['role']})
+    return user_list, prev_cursor, next_cursor
+
+# In-process prefix index of user emails for the assignment typeahead. It is
+# warmed in the background at startup, kept current by the signup/edit/delete
+# routes in this process and rebuilt every USER_INDEX_REFRESH seconds so that
+# changes made by other workers show up eventually.
+USER_INDEX_REFRESH = 300
+USER_SEARCH_LIMIT = 10
+
+class UserPrefixIndex:
+    """Sorted (email, uid) arrays per role, searched by prefix with bisect."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_role = {role: [] for role in LISTED_ROLES}
+        self.users = {}  # uid -> (role, email)
+        self.loaded_at = None
+        self.refreshing = False
+
+    def load(self, users):
+        """Replace the index contents with an iterable of (uid, email, role)."""
+        by_role = {role: [] for role in LISTED_ROLES}
+        user_map = {}
+        for uid, email, role in users:
+            if role in by_role:
+                by_role[role].append((email.lower(), uid, email))
+                user_map[uid] = (role, email)
+        for entries in by_role.values():
+            entries.sort()
+        with self.lock:
+            self.by_role = by_role
+            self.users = user_map
+            self.loaded_at = time.monotonic()
+
+    def add(self, uid, email, role):
+        with self.lock:
+            self._remove(uid)
+            if role in self.by_role:
+                bisect.insort(self.by_role[role], (email.lower(), uid, email))
+                self.users[uid] = (role, email)
+
+    def update_email(self, uid, email):
+        with self.lock:
+            if uid in self.users:
+                role, _ = self.users[uid]
+                self._remove(uid)
+                bisect.insort(self.by_role[role], (email.lower(), uid, email))
+                self.users[uid] = (role, email)
+
+    def remove(self, uid):
+        with self.lock:
+            self._remove(uid)
+
+    def clear(self):
+        """Empty the index; searches fall back to Firestore until it is warmed again."""
+        with self.lock:
+            self.by_role = {role: [] for role in LISTED_ROLES}
+            self.users = {}
+            self.loaded_at = None
+
+    def _remove(self, uid):
+        if uid not in self.users:
+            return
+        role, email = self.users.pop(uid)
+        entries = self.by_role[role]
+        i = bisect.bisect_left(entries, (email.lower(), uid, email))
+        if i < len(entries) and entries[i][1] == uid:
+            del entries[i]
+
+    def search(self, role, prefix, limit):
+        """Return up to limit {'id', 'email'} dicts for users of role whose email starts with prefix."""
+        prefix = prefix.lower()
+        results = []
+        with self.lock:
+            entries = self.by_role.get(role, [])
+            for key, uid, email in entries[bisect.bisect_left(entries, (prefix,)):]:
+                if not key.startswith(prefix) or len(results) >= limit:
+                    break
+                results.append({'id': uid, 'email': email})
+        return results
+
+user_index = LocalProxy(lambda: current_app.extensions['user_index'])
+
+def warm_user_index(app):
+    """Load every doctor and patient email into the app's prefix index."""
+    with app.app_context():
+        try:
+            users = (db.collection('users')
+                     .where(filter=FieldFilter('role', 'in', LISTED_ROLES))
+                     .select(['email', 'role'])
+                     .stream())
+            user_index.load((doc.id, doc.get('email'), doc.get('role')) for doc in users)
+        except Exception:
+            logger.exception("Error warming user index")
+        finally:
+            user_index.refreshing = False
+
+def refresh_user_index():
+    """Start a background rebuild of the prefix index unless one is already running."""
+    with user_index.lock:
+        if user_index.refreshing:
+            return
+        user_index.refreshing = True
+    threading.Thread(target=warm_user_index, args=(current_app._get_current_object(),), daemon=True).start()
+
+def search_users_by_prefix(role, prefix, limit=USER_SEARCH_LIMIT):
+    """Search users by email prefix, falling back to Firestore until the index is warm."""
+    loaded_at = user_index.loaded_at
+    if loaded_at is None or time.monotonic() - loaded_at > USER_INDEX_REFRESH:
+        refresh_user_index()
+    if loaded_at is None:
+        prefix = prefix.strip().lower()
+        docs = (db.collection('users')
+                .where(filter=FieldFilter('role', '==', role))
+                .where(filter=FieldFilter('email_lower', '>=', prefix))
+                .where(filter=FieldFilter('email_lower', '<', prefix + '\uf8ff'))
+                .order_by('email_lower')
+                .select(['email'])
+                .limit(limit)
+                .stream())
+        return [{'id': doc.id, 'email': doc.get('email')} for doc in docs]
+    return user_index.search(role, prefix.strip(), limit)
+
+# Bulk operations. Uploads are CSV (with a header row) or a JSON list of
+# objects; Firestore writes go through batched writes and Auth accounts are
+# created with auth.import_users, which takes at most 1000 users per call.
+BULK_MAX_ROWS = 5000
+AUTH_IMPORT_LIMIT = 1000
+AUTH_LOOKUP_LIMIT = 100
+# Imported passwords are hashed locally with PBKDF2-SHA256; Firebase accepts at most 120000 rounds
+PASSWORD_HASH_ROUNDS = 100000
+PASSWORD_HASH_WORKERS = 8
+# Hashing takes about 30 ms of CPU per password and runs inside the request, so
+# sign-up uploads are kept well inside a worker's request timeout. It stays at
+# or under BATCH_WRITE_LIMIT, so the users' documents are written in one batch.
+BULK_SIGNUP_MAX_ROWS = 500
+
+def parse_upload(upload):
+    """Read an uploaded CSV or JSON file into a list of row dicts."""
+    if upload.filename.lower().endswith('.json'):
+        rows = json.load(upload.stream)
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise ValueError('JSON uploads must be a list of objects.')
+    else:
+        rows = list(csv.DictReader(io.TextIOWrapper(upload.stream, encoding='utf-8-sig')))
+
+    if len(rows) > BULK_MAX_ROWS:
+        raise ValueError(f'Uploads are limited to {BULK_MAX_ROWS} rows.')
+    return [{key.strip(): str(value or '').strip() for key, value in row.items() if key} for row in rows]
+
+def bulk_assign(rows):
+    """Assign patients to doctors from rows with 'doctor_id' and 'patient_id' columns.
+
+    All users are read in batched lookups and all assignments are written with
+    batched ArrayUnion writes, which are idempotent, so a failed upload can
+    simply be retried. Returns one result dict per row.
+    """
+    user_ids = [row.get(column, '') for row in rows for column in ('doctor_id', 'patient_id')]
+    user_ids = [user_id for user_id in dict.fromkeys(user_ids) if user_id]
+    users = dict(zip(user_ids, get_users(user_ids, cached=False)))
+
+    results = []
+    new_assignments = {}  # doctor_id -> [patient_id]
+    for row_number, row in enumerate(rows, start=1):
+        doctor_id, patient_id = row.get('doctor_id', ''), row.get('patient_id', '')
+        doctor_data, patient_data = users.get(doctor_id), users.get(patient_id)
+
+        if not doctor_data or doctor_data.get('role') != 'doctor':
+            status = 'doctor_not_found'
+        elif not patient_data or patient_data.get('role') != 'patient':
+            status = 'patient_not_found'
+        elif (patient_id in parse_assigned_patients(doctor_data.get('assigned_patients', []))
+              or patient_id in new_assignments.get(doctor_id, [])):
+            status = 'already_assigned'
+        else:
+            new_assignments.setdefault(doctor_id, []).append(patient_id)
+            status = 'assigned'
+        results.append({'row': row_number, 'doctor_id': doctor_id, 'patient_id': patient_id, 'status': status})
+
+    updates = []
+    for doctor_id, patient_ids in new_assignments.items():
+        current_value = users[doctor_id].get('assigned_patients', [])
+        updates.append((db.collection('users').document(doctor_id),
+                        {'assigned_patients': assigned_patients_update(current_value, patient_ids, 'assign')}))
+        for patient_id in patient_ids:
+            updates.append((db.collection('users').document(patient_id),
+                            {'assigned_doctors': firestore.ArrayUnion([doctor_id])}))
+    batch_update(updates)
+
+    invalidate_users(*new_assignments, *(patient_id for patient_ids in new_assignments.values() for patient_id in patient_ids))
+    invalidate_assignments(*new_assignments)
+    return results
+
+def hash_password(password, salt):
+    return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, PASSWORD_HASH_ROUNDS)
+
+def existing_emails(emails):
+    """Return the subset of emails that already belong to a Firebase Auth account."""
+    lookups = [partial(auth.get_users, [firebase_auth.EmailIdentifier(email) for email in emails[i:i + AUTH_LOOKUP_LIMIT]])
+               for i in range(0, len(emails), AUTH_LOOKUP_LIMIT)]
+    return {user.email.lower() for result in run_concurrently(*lookups) for user in result.users if user.email}
+
+def bulk_signup(rows):
+    """Create doctors and patients from rows with 'email', 'password' and 'role' columns.
+
+    auth.import_users does not check that emails are unique, so emails that
+    already have an account are looked up first and reported as 'exists'. If
+    the users' documents cannot be written, the imported accounts are deleted
+    again so the upload can simply be retried. Returns one result dict per row.
+    """
+    if len(rows) > BULK_SIGNUP_MAX_ROWS:
+        raise ValueError(f'Sign-up uploads are limited to {BULK_SIGNUP_MAX_ROWS} rows.')
+
+    results = []
+    valid = []  # (result, email, password, role)
+    seen_emails = set()
+    for row_number, row in enumerate(rows, start=1):
+        email, password, role = row.get('email', '').lower(), row.get('password', ''), row.get('role', '').lower()
+        result = {'row': row_number, 'email': email, 'role': role, 'uid': None, 'status': 'created', 'message': ''}
+        results.append(result)
+
+        if role not in LISTED_ROLES:
+            result['status'], result['message'] = 'invalid', 'Role must be doctor or patient.'
+        elif not email or '@' not in email:
+            result['status'], result['message'] = 'invalid', 'Invalid email.'
+        elif len(password) < 6:
+            result['status'], result['message'] = 'invalid', 'Password must be at least 6 characters.'
+        elif email in seen_emails:
+            result['status'], result['message'] = 'invalid', 'Duplicate email in upload.'
+        else:
+            seen_emails.add(email)
+            valid.append((result, email, password, role))
+
+    taken = existing_emails([email for _, email, _, _ in valid])
+    for result, email, _, _ in valid:
+        if email in taken:
+            result['status'], result['message'] = 'exists', 'A user with this email already exists.'
+    valid = [entry for entry in valid if entry[1] not in taken]
+
+    # PBKDF2 releases the GIL, so hashing parallelises across threads
+    salts = [os.urandom(16) for _ in valid]
+    with ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS) as pool:
+        hashes = list(pool.map(hash_password, [password for _, _, password, _ in valid], salts))
+
+    hash_alg = firebase_auth.UserImportHash.pbkdf2_sha256(rounds=PASSWORD_HASH_ROUNDS)
+    chunks, imports = [], []
+    for start in range(0, len(valid), AUTH_IMPORT_LIMIT):
+        chunk = valid[start:start + AUTH_IMPORT_LIMIT]
+        records = []
+        for i, (result, email, _, role) in enumerate(chunk, start=start):
+            result['uid'] = uuid.uuid4().hex
+            records.append(firebase_auth.ImportUserRecord(uid=result['uid'], email=email,
+                                                          password_hash=hashes[i], password_salt=salts[i],
+                                                          custom_claims=role_claims(role)))
+        chunks.append(chunk)
+        imports.append(partial(auth.import_users, records, hash_alg=hash_alg))
+
+    created = []
+    for chunk, import_result in zip(chunks, run_concurrently(*imports)):
+        failed = {error.index: error.reason for error in import_result.errors}
+        for i, entry in enumerate(chunk):
+            if i in failed:
+                entry[0]['status'], entry[0]['message'], entry[0]['uid'] = 'failed', failed[i], None
+            else:
+                created.append(entry)
 
-# Initialize Firebase
-cred = credentials.Certificate('firebase credential file here')
-firebase_admin.initialize_app(cred, {
-    'storageBucket': 'firebase bucket here'  # Ensure this matches your Firebase project
-})
-db = firestore.client()
-bucket = storage.bucket()
+    documents = []
+    for result, email, _, role in created:
+        data = {'email': email, 'email_lower': email.lower(), 'role': role}
+        if role == 'doctor':
+            data['assigned_patients'] = []
+        else:
+            data.update(assigned_doctors=[], doctors_indexed=True)
+        documents.append((db.collection('users').document(result['uid']), data))
+    try:
+        batch_set(documents)
+    except Exception:
+        # Without their documents the accounts cannot log in; remove them so a retry does not duplicate them
+        uids = [result['uid'] for result, _, _, _ in created]
+        run_concurrently(*(partial(auth.delete_users, uids[i:i + AUTH_IMPORT_LIMIT])
+                           for i in range(0, len(uids), AUTH_IMPORT_LIMIT)))
+        raise
+
+    for result, email, _, role in created:
+        invalidate_users(result['uid'])
+        user_index.add(result['uid'], email, role)
+    return results
+
+# Background jobs. Slow admin operations are queued on the app's JobQueue (see
+# jobs.py) and run outside the request, so admin requests take the same time
+# however much data an operation touches. Handlers run in an app context, may
+# be retried after a partial run and so must be idempotent.
+JOB_HANDLERS = {}
+# Jobs an admin can start from the job status page
+MAINTENANCE_JOBS = {
+    'rebuild_pdf_summaries': 'Rebuild PDF summaries',
+    'migrate_assigned_patients': 'Migrate assigned patients to arrays',
+    'backfill_email_lower': 'Backfill lowercase emails for user search',
+}
+PDF_CLEANUP_PAGE_SIZE = 200
+
+def job_handler(kind):
+    """Register a function of a job's payload as the handler for a kind of job."""
+    def register(fn):
+        JOB_HANDLERS[kind] = fn
+        return fn
+    return register
+
+def enqueue_job(kind, payload, key=None):
+    return current_app.extensions['jobs'].enqueue(kind, payload, key)
+
+@job_handler('delete_user')
+def delete_user_job(payload):
+    """Delete a user, unlink them from their doctors or patients, and queue the cleanup of a patient's PDFs."""
+    user_id = payload['user_id']
+    # Read past the cache, since we write based on the result
+    user_data, = get_users([user_id], cached=False)
+    if not user_data:
+        return {'status': 'not_found'}
+
+    updates = []
+    related_ids = []
+
+    # If the user is a patient, remove their ID from the assigned patients list of their doctors
+    if user_data['role'] == 'patient':
+        enqueue_job('delete_patient_pdfs', {'patient_id': user_id}, key=f'delete_patient_pdfs:{user_id}')
+        related_ids = get_patient_doctor_ids(user_id, user_data)
+        for doctor_id, doctor_data in zip(related_ids, get_users(related_ids, cached=False)):
+            if not doctor_data:
+                continue
+            current_value = doctor_data.get('assigned_patients', [])
+            if user_id in parse_assigned_patients(current_value):
+                updates.append((db.collection('users').document(doctor_id),
+                                {'assigned_patients': assigned_patients_update(current_value, [user_id], 'unassign')}))
+
+    # If the user is a doctor, remove their ID from the assigned doctors list of their patients
+    elif user_data['role'] == 'doctor':
+        related_ids = parse_assigned_patients(user_data.get('assigned_patients', []))
+        updates = [
+            (db.collection('users').document(patient_id), {'assigned_doctors': firestore.ArrayRemove([user_id])})
+            for patient_id, patient_data in zip(related_ids, get_users(related_ids, cached=False))
+            if patient_data
+        ]
+
+    def delete_auth_user():
+        # A retried job may already have deleted the account
+        try:
+            auth.delete_user(user_id)
+        except firebase_auth.UserNotFoundError:
+            pass
+
+    # Rewriting the related users and deleting the user from Firebase Authentication are independent
+    run_concurrently(partial(batch_update, updates), delete_auth_user)
+    invalidate_users(*related_ids)
+    # The Firestore document goes last, so a retry still finds the user and redoes the steps above
+    db.collection('users').document(user_id).delete()
+    invalidate_users(user_id)
+    # A deleted patient's doctors lose access to their PDFs; a deleted doctor loses access to all
+    invalidate_assignments(*related_ids, user_id)
+    mark_user_changed(user_id)
+    user_index.remove(user_id)
+    return {'status': 'deleted', 'role': user_data['role'], 'related_users': len(related_ids)}
+
+def release_pdf_file(patient_id, pdf_file, sha256):
+    """Drop a patient's use of a stored PDF, deleting the blob unless another patient's PDF shares it.
+
+    Uploads of identical content are linked to one blob (see uploads.py), so
+    a blob is only deleted when no other patient's 'pdfs' document points at
+    it. Returns True if the blob was deleted.
+    """
+    sharing = db.collection('pdfs').where(filter=FieldFilter('pdf_file', '==', pdf_file)).select(['patient_id']).stream()
+    if any(doc.get('patient_id') != patient_id for doc in sharing):
+        if sha256:
+            try:
+                db.collection('pdf_hashes').document(sha256).update({'patient_ids': firestore.ArrayRemove([patient_id])})
+            except NotFound:
+                pass
+        return False
+
+    # The hash entry goes first, so no new upload is linked to a blob that is about to disappear
+    if sha256:
+        db.collection('pdf_hashes').document(sha256).delete()
+    try:
+        bucket.blob(pdf_file).delete()
+    except NotFound:
+        pass
+    return True
+
+@job_handler('delete_patient_pdfs')
+def delete_patient_pdfs_job(payload):
+    """Delete a patient's 'pdfs' documents, their PDF summary and the blobs no one else uses."""
+    patient_id = payload['patient_id']
+    query = (db.collection('pdfs')
+             .where(filter=FieldFilter('patient_id', '==', patient_id))
+             .limit(PDF_CLEANUP_PAGE_SIZE))
+    pdfs_deleted = blobs_deleted = 0
+    while True:
+        page = list(query.stream())
+        if not page:
+            break
+        # Blobs are released before the documents that point at them are deleted, so a retry finds them again
+        pdf_files = {doc.get('pdf_file'): doc.to_dict().get('sha256') for doc in page}
+        released = run_concurrently(*(partial(release_pdf_file, patient_id, pdf_file, sha256)
+                                      for pdf_file, sha256 in pdf_files.items()))
+        blobs_deleted += sum(released)
+        batch = db.batch()
+        for doc in page:
+            batch.delete(doc.reference)
+        batch.commit()
+        pdfs_deleted += len(page)
+
+    db.collection('pdf_summaries').document(patient_id).delete()
+    return {'pdfs_deleted': pdfs_deleted, 'blobs_deleted': blobs_deleted}
+
+@job_handler('bulk_assign')
+def bulk_assign_job(payload):
+    results = bulk_assign(payload['rows'])
+    return {'results': results, 'assigned': sum(1 for result in results if result['status'] == 'assigned')}
+
+@job_handler('rebuild_pdf_summaries')
+def rebuild_pdf_summaries_job(payload):
+    return {'rebuilt': len(check_summaries(db, fix=True))}
+
+@job_handler('migrate_assigned_patients')
+def migrate_assigned_patients_job(payload):
+    # The migration checkpoints its progress, so a retry resumes where the last attempt stopped
+    migrate_assigned_patients(db, payload['checkpoint'])
+    user_cache.clear()
+    assignment_cache.clear()
+    return {'status': 'migrated'}
+
+@job_handler('backfill_email_lower')
+def backfill_email_lower_job(payload):
+    # Like the migration, retries resume from the run's checkpoint
+    return {'updated': backfill_email_lower(db, payload['checkpoint'])}
 
 # User class for Flask-Login
 class User(UserMixin):
@@ -32,25 +1226,52 @@ class User(UserMixin):
         self.email = email
         self.role = role
 
+# A user's role is stored as a Firebase Auth custom claim, so login needs only
+# the Auth lookup. The logged-in user's email and role are then kept in the
+# signed session cookie and load_user rebuilds the user from it without a
+# backend read. The session copy is rechecked against Firestore every
+# SESSION_REVALIDATE seconds, and at once in this process after the user is
+# edited or deleted here.
+SESSION_REVALIDATE = 300
+changed_users = LocalProxy(lambda: current_app.extensions['changed_users'])  # uid -> time.time() of the last change
+
+def role_claims(role):
+    return {'role': role}
+
+def remember_user(uid, email, role):
+    """Store the logged-in user's profile in the session."""
+    session['profile'] = {'uid': uid, 'email': email, 'role': role, 'checked_at': time.time()}
+
+def mark_user_changed(user_id):
+    """Make sessions of user_id revalidate against Firestore on their next request to this process."""
+    changed_users.set(user_id, time.time())
+
 # User loader callback for Flask-Login
-@login_manager.user_loader
 def load_user(user_id):
+    profile = session.get('profile')
+    if profile and profile.get('uid') == user_id:
+        changed_at = changed_users.get(user_id)
+        if (time.time() - profile['checked_at'] < SESSION_REVALIDATE
+                and (changed_at is None or changed_at < profile['checked_at'])):
+            return User(uid=user_id, email=profile['email'], role=profile['role'])
+
     try:
-        user_doc = db.collection('users').document(user_id).get()
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
+        user_data, = get_users([user_id])
+        if user_data:
+            remember_user(user_id, user_data['email'], user_data['role'])
             return User(uid=user_id, email=user_data['email'], role=user_data['role'])
-    except Exception as e:
-        print(f"Error loading user: {e}")
+    except Exception:
+        logger.exception("Error loading user")
+    session.pop('profile', None)
     return None
 
 # Route: Home redirects to login
-@app.route('/')
+@main.route('/')
 def index():
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
 # Route: Login
-@app.route('/login', methods=['GET', 'POST'])
+@main.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         email = request.form['email']
@@ -59,231 +1280,258 @@ def login():
         try:
             # Firebase Authentication: Sign in user
             user = auth.get_user_by_email(email)
-            user_data = db.collection('users').document(user.uid).get().to_dict()
-            login_user(User(uid=user.uid, email=email, role=user_data['role']))
+            role = (user.custom_claims or {}).get('role')
+            if role is None:
+                # Accounts created before roles were stored as claims get theirs on first login
+                role = db.collection('users').document(user.uid).get().to_dict()['role']
+                auth.set_custom_user_claims(user.uid, role_claims(role))
+            login_user(User(uid=user.uid, email=email, role=role))
+            remember_user(user.uid, email, role)
             flash('Logged in successfully.', 'success')
 
-            if user_data['role'] == 'patient':
-                return redirect(url_for('patient_dashboard'))
-            elif user_data['role'] == 'doctor':
-                return redirect(url_for('doctor_dashboard'))
-            elif user_data['role'] == 'admin':
-                return redirect(url_for('admin_dashboard'))
+            if role == 'patient':
+                return redirect(url_for('main.patient_dashboard'))
+            elif role == 'doctor':
+                return redirect(url_for('main.doctor_dashboard'))
+            elif role == 'admin':
+                return redirect(url_for('main.admin_dashboard'))
             else:
                 flash('Invalid user role.', 'danger')
-                return redirect(url_for('login'))
+                return redirect(url_for('main.login'))
 
         except Exception as e:
-            print(f"Login error: {e}")
+            logger.warning(f"Login error: {e}")
             flash('Login failed. Please check your credentials.', 'danger')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
 
     return render_template('login.html')
 
 # Route: Logout
-@app.route('/logout')
+@main.route('/logout')
 @login_required
 def logout():
     logout_user()
     flash('You have been logged out.', 'info')
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
 # Route: Patient Dashboard
-@app.route('/patient_dashboard')
+@main.route('/patient_dashboard')
 @login_required
 def patient_dashboard():
     if current_user.role != 'patient':
         flash('Access denied.', 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
     try:
-        # Fetch PDFs for the logged-in patient, sorted by upload_date in descending order
-        pdfs = db.collection('pdfs').where(filter=FieldFilter('patient_id', '==', current_user.id)).order_by('upload_date', direction=firestore.Query.DESCENDING).stream()
-
-        # Generate list of PDFs for the patient
-        pdf_list = []
-        for pdf in pdfs:
-            pdf_data = pdf.to_dict()
-            pdf_list.append({
-                'id': pdf.id,
-                'pdf_url': pdf_data['pdf_url'],  # URL pointing to the PDF in Firebase Storage
-                'upload_date': pdf_data['upload_date'],  # Use the string value directly
-                'message': None
-            })
+        # A browser holding the current page gets a 304 without the page being rebuilt
+        summary = get_pdf_summary(current_user.id)
+        etag = pdf_page_etag(summary)
+        if etag is not None:
+            response = not_modified(etag, weak=True)
+            if response is not None:
+                return response
 
-        # Debugging: Print the fetched PDFs
-        print("Fetched PDFs for patient:", pdf_list)
+        # Fetch one page of PDFs for the logged-in patient, sorted by upload_date in descending order
+        pdf_list, prev_cursor, next_cursor = get_pdf_page(
+            current_user.id, summary, request.args.get('after'), request.args.get('before'))
+
+        logger.debug("Fetched PDFs for patient: %s", pdf_list)
 
         # If no PDFs are found for the patient, provide a placeholder message
         if not pdf_list:
             flash('No PDF records found.', 'info')
-            return render_template('patient_dashboard.html', pdfs=[])
-
-        return render_template('patient_dashboard.html', pdfs=pdf_list)
-
-    except Exception as e:
-        print(f"Error fetching PDFs: {e}")
+            response = make_response(render_template('patient_dashboard.html', pdfs=[]))
+        else:
+            response = make_response(render_template('patient_dashboard.html', pdfs=pdf_list,
+                                                     prev_cursor=prev_cursor, next_cursor=next_cursor))
+        if etag is not None:
+            response.set_etag(etag, weak=True)
+        return response
+
+    except Exception:
+        logger.exception("Error fetching PDFs")
         flash('Failed to retrieve PDFs.', 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
 # Route: Doctor Dashboard
-@app.route('/doctor_dashboard')
+@main.route('/doctor_dashboard')
 @login_required
 def doctor_dashboard():
     if current_user.role != 'doctor':
         flash('Access denied.', 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
     try:
-        # Fetch the doctor's document
-        doctor_doc = db.collection('users').document(current_user.id).get()
-        if not doctor_doc.exists:
+        # Fetch the doctor's document (already memoized by load_user for this request)
+        doctor_data, = get_users([current_user.id])
+        if not doctor_data:
             flash('Doctor not found.', 'danger')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
 
-        # Retrieve assigned patients and safely convert the string to a list
-        assigned_patients_str = doctor_doc.to_dict().get('assigned_patients', '[]')
-        assigned_patients = ast.literal_eval(assigned_patients_str)
+        # Retrieve assigned patients
+        assigned_patients = parse_assigned_patients(doctor_data.get('assigned_patients', []))
 
-        # Fetch patient details
+        # Fetch patient details in batched reads
         patients = []
-        for patient_id in assigned_patients:
-            patient_doc = db.collection('users').document(patient_id).get()
-            if patient_doc.exists:
-                patient_data = patient_doc.to_dict()
+        for patient_id, patient_data in zip(assigned_patients, get_users(assigned_patients)):
+            if patient_data:
                 patients.append({
                     'id': patient_id,
                     'email': patient_data['email']
                 })
 
         return render_template('doctor_dashboard.html', patients=patients)
-    except Exception as e:
-        print(f"Error fetching doctor dashboard: {e}")
+    except Exception:
+        logger.exception("Error fetching doctor dashboard")
         flash('Failed to retrieve patient information.', 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
 # Route: View Patient PDFs
-@app.route('/view_patient_pdfs/<patient_id>')
+@main.route('/view_patient_pdfs/<patient_id>')
 @login_required
 def view_patient_pdfs(patient_id):
     if current_user.role != 'doctor':
         flash('Access denied.', 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
     try:
-        # Fetch PDFs for the specified patient, sorted by upload_date in descending order
-        pdfs = db.collection('pdfs').where(filter=FieldFilter('patient_id', '==', patient_id)).order_by('upload_date', direction=firestore.Query.DESCENDING).stream()
-
-        # Generate list of PDFs for the patient
-        pdf_list = []
-        for pdf in pdfs:
-            pdf_data = pdf.to_dict()
-            pdf_list.append({
-                'id': pdf.id,
-                'pdf_url': pdf_data['pdf_url'],  # URL pointing to the PDF in Firebase Storage
-                'upload_date': pdf_data['upload_date'],  # Use the string value directly
-                'message': None
-            })
+        # Doctors may only see the PDFs of their own patients. The summary is read meanwhile and
+        # dropped if access is denied
+        allowed, summary = run_concurrently(partial(doctor_can_access, current_user.id, patient_id),
+                                            partial(get_pdf_summary, patient_id))
+        if not allowed:
+            flash('Access denied.', 'danger')
+            return redirect(url_for('main.doctor_dashboard'))
 
-        # Debugging: Print the fetched PDFs
-        print("Fetched PDFs for patient:", pdf_list)
+        # A browser holding the current page gets a 304 without the page being rebuilt
+        etag = pdf_page_etag(summary)
+        if etag is not None:
+            response = not_modified(etag, weak=True)
+            if response is not None:
+                return response
+
+        # Fetch one page of PDFs for the specified patient, sorted by upload_date in descending order
+        pdf_list, prev_cursor, next_cursor = get_pdf_page(
+            patient_id, summary, request.args.get('after'), request.args.get('before'))
+
+        logger.debug("Fetched PDFs for patient: %s", pdf_list)
 
         # If no PDFs are found for the patient, provide a placeholder message
         if not pdf_list:
             flash('No PDF records found.', 'info')
-            return render_template('view_patient_pdfs.html', pdfs=[])
-
-        return render_template('view_patient_pdfs.html', pdfs=pdf_list, patient_id=patient_id)
-
-    except Exception as e:
-        print(f"Error fetching PDFs: {e}")
+            response = make_response(render_template('view_patient_pdfs.html', pdfs=[], patient_id=patient_id))
+        else:
+            response = make_response(render_template('view_patient_pdfs.html', pdfs=pdf_list, patient_id=patient_id,
+                                                     prev_cursor=prev_cursor, next_cursor=next_cursor))
+        if etag is not None:
+            response.set_etag(etag, weak=True)
+        return response
+
+    except Exception:
+        logger.exception("Error fetching PDFs")
         flash('Failed to retrieve PDFs.', 'danger')
-        return redirect(url_for('doctor_dashboard'))
+        return redirect(url_for('main.doctor_dashboard'))
 
 # Route: Admin Dashboard
-@app.route('/admin_dashboard')
+@main.route('/admin_dashboard')
 @login_required
 def admin_dashboard():
     if current_user.role != 'admin':
         flash('Access denied.', 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
+
+    role = request.args.get('role', '')
+    email_prefix = request.args.get('q', '')
 
     try:
-        users = db.collection('users').where('role', '!=', 'admin').stream()
-        user_list = [{'id': doc.id, 'email': doc.to_dict()['email'], 'role': doc.to_dict()['role']} for doc in users]
-        return render_template('admin_dashboard.html', users=user_list)
-    except Exception as e:
-        print(f"Error fetching users: {e}")
+        user_list, prev_cursor, next_cursor = get_user_page(
+            role, email_prefix, request.args.get('after'), request.args.get('before'))
+        return render_template('admin_dashboard.html', users=user_list, role=role, q=email_prefix,
+                               prev_cursor=prev_cursor, next_cursor=next_cursor)
+    except Exception:
+        logger.exception("Error fetching users")
         flash('Failed to retrieve users.', 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
 
 # Route: Sign Up Doctor
-@app.route('/signup_doctor', methods=['GET', 'POST'])
+@main.route('/signup_doctor', methods=['GET', 'POST'])
 @login_required
 def signup_doctor():
     if current_user.role != 'admin':
         flash('Access denied.', 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
     if request.method == 'POST':
-        email = request.form['email']
+        email = request.form['email'].strip().lower()
         password = request.form['password']
 
         try:
             # Create user in Firebase Authentication
             user = auth.create_user(email=email, password=password)
-            # Add user to Firestore
-            db.collection('users').document(user.uid).set({
-                'email': email,
-                'role': 'doctor',
-                'assigned_patients': '[]'
-            })
+            # Store the role as a claim and add the user to Firestore
+            run_concurrently(
+                partial(auth.set_custom_user_claims, user.uid, role_claims('doctor')),
+                partial(db.collection('users').document(user.uid).set, {
+                    'email': email,
+                    'email_lower': email.lower(),
+                    'role': 'doctor',
+                    'assigned_patients': []
+                }))
+            invalidate_users(user.uid)
+            user_index.add(user.uid, email, 'doctor')
             flash('Doctor signed up successfully.', 'success')
-            return redirect(url_for('admin_dashboard'))
-        except Exception as e:
-            print(f"Error signing up doctor: {e}")
+            return redirect(url_for('main.admin_dashboard'))
+        except Exception:
+            logger.exception("Error signing up doctor")
             flash('Failed to sign up doctor.', 'danger')
-            return redirect(url_for('signup_doctor'))
+            return redirect(url_for('main.signup_doctor'))
 
     return render_template('signup_doctor.html')
 
 # Route: Sign Up Patient
-@app.route('/signup_patient', methods=['GET', 'POST'])
+@main.route('/signup_patient', methods=['GET', 'POST'])
 @login_required
 def signup_patient():
     if current_user.role != 'admin':
         flash('Access denied.', 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
     if request.method == 'POST':
-        email = request.form['email']
+        email = request.form['email'].strip().lower()
         password = request.form['password']
 
         try:
             # Create user in Firebase Authentication
             user = auth.create_user(email=email, password=password)
-            # Add user to Firestore
-            db.collection('users').document(user.uid).set({
-                'email': email,
-                'role': 'patient'
-            })
+            # Store the role as a claim and add the user to Firestore
+            run_concurrently(
+                partial(auth.set_custom_user_claims, user.uid, role_claims('patient')),
+                partial(db.collection('users').document(user.uid).set, {
+                    'email': email,
+                    'email_lower': email.lower(),
+                    'role': 'patient',
+                    'assigned_doctors': [],
+                    'doctors_indexed': True
+                }))
+            invalidate_users(user.uid)
+            user_index.add(user.uid, email, 'patient')
             flash('Patient signed up successfully.', 'success')
-            return redirect(url_for('admin_dashboard'))
-        except Exception as e:
-            print(f"Error signing up patient: {e}")
+            return redirect(url_for('main.admin_dashboard'))
+        except Exception:
+            logger.exception("Error signing up patient")
             flash('Failed to sign up patient.', 'danger')
-            return redirect(url_for('signup_patient'))
+            return redirect(url_for('main.signup_patient'))
 
     return render_template('signup_patient.html')
 
 # Route: Assign/Unassign Patient
-@app.route('/assign_unassign_patient', methods=['GET', 'POST'])
+@main.route('/assign_unassign_patient', methods=['GET', 'POST'])
 @login_required
 def assign_unassign_patient():
     if current_user.role != 'admin':
         flash('Access denied.', 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
     if request.method == 'POST':
         doctor_id = request.form['doctor_id']
@@ -291,180 +1539,389 @@ def assign_unassign_patient():
         action = request.form['action']
 
         try:
-            # Fetch the doctor's document
-            doctor_doc = db.collection('users').document(doctor_id).get()
-            if not doctor_doc.exists:
+            if action not in ('assign', 'unassign'):
+                flash('Invalid action.', 'danger')
+                return redirect(url_for('main.assign_unassign_patient'))
+
+            # Update the doctor's and patient's documents in one transaction
+            result = update_assignment(db.transaction(), doctor_id, patient_id, action)
+            invalidate_users(doctor_id, patient_id)
+            invalidate_assignments(doctor_id)
+
+            if result == 'doctor_not_found':
                 flash('Doctor not found.', 'danger')
-                return redirect(url_for('assign_unassign_patient'))
-
-            # Update the doctor's assigned patients
-            assigned_patients_str = doctor_doc.to_dict().get('assigned_patients', '[]')
-            assigned_patients = ast.literal_eval(assigned_patients_str)
-
-            if action == 'assign':
-                if patient_id not in assigned_patients:
-                    assigned_patients.append(patient_id)
-                    db.collection('users').document(doctor_id).update({
-                        'assigned_patients': str(assigned_patients)
-                    })
-                    flash('Patient assigned to doctor successfully.', 'success')
-                else:
-                    flash('Patient already assigned to this doctor.', 'info')
-            elif action == 'unassign':
-                if patient_id in assigned_patients:
-                    assigned_patients.remove(patient_id)
-                    db.collection('users').document(doctor_id).update({
-                        'assigned_patients': str(assigned_patients)
-                    })
-                    flash('Patient unassigned from doctor successfully.', 'success')
-                else:
-                    flash('Patient not assigned to this doctor.', 'info')
-
-            return redirect(url_for('assign_unassign_patient'))
-        except Exception as e:
-            print(f"Error assigning/unassigning patient: {e}")
+            elif result == 'patient_not_found':
+                flash('Patient not found.', 'danger')
+            elif result == 'assigned':
+                flash('Patient assigned to doctor successfully.', 'success')
+            elif result == 'already_assigned':
+                flash('Patient already assigned to this doctor.', 'info')
+            elif result == 'unassigned':
+                flash('Patient unassigned from doctor successfully.', 'success')
+            else:
+                flash('Patient not assigned to this doctor.', 'info')
+
+            return redirect(url_for('main.assign_unassign_patient'))
+        except Exception:
+            logger.exception("Error assigning/unassigning patient")
             flash('Failed to assign/unassign patient.', 'danger')
-            return redirect(url_for('assign_unassign_patient'))
+            return redirect(url_for('main.assign_unassign_patient'))
+
+    # Doctors and patients are looked up by the page through search_users
+    return render_template('assign_unassign_patient.html')
 
+# Route: Search Users (typeahead for assign/unassign)
+@main.route('/search_users')
+@login_required
+def search_users():
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Access denied.'}), 403
+
+    role = request.args.get('role', '')
+    if role not in LISTED_ROLES:
+        return jsonify({'error': 'Invalid role.'}), 400
+
+    limit = max(1, min(request.args.get('limit', USER_SEARCH_LIMIT, type=int), 50))
     try:
-        doctors = db.collection('users').where('role', '==', 'doctor').stream()
-        patients = db.collection('users').where('role', '==', 'patient').stream()
-        doctors_list = [{'id': doc.id, 'email': doc.to_dict()['email']} for doc in doctors]
-        patients_list = [{'id': doc.id, 'email': doc.to_dict()['email']} for doc in patients]
-        return render_template('assign_unassign_patient.html', doctors=doctors_list, patients=patients_list)
-    except Exception as e:
-        print(f"Error fetching doctors and patients: {e}")
-        flash('Failed to retrieve doctors and patients.', 'danger')
-        return redirect(url_for('login'))
+        return jsonify(search_users_by_prefix(role, request.args.get('q', ''), limit))
+    except Exception:
+        logger.exception("Error searching users")
+        return jsonify({'error': 'Failed to search users.'}), 500
+
+
+# Route: Bulk Assign Patients
+@main.route('/bulk_assign', methods=['GET', 'POST'])
+@login_required
+def bulk_assign_patients():
+    if current_user.role != 'admin':
+        flash('Access denied.', 'danger')
+        return redirect(url_for('main.login'))
+
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash('Please choose a CSV or JSON file.', 'danger')
+            return redirect(url_for('main.bulk_assign_patients'))
+
+        try:
+            job_id = enqueue_job('bulk_assign', {'rows': parse_upload(upload)})
+            flash('Upload queued.', 'success')
+            return redirect(url_for('main.bulk_assign_patients', job=job_id))
+        except Exception:
+            logger.exception("Error bulk assigning patients")
+            flash('Failed to process the upload.', 'danger')
+            return redirect(url_for('main.bulk_assign_patients'))
+
+    # Show the progress, then the results, of a queued upload
+    job = None
+    if request.args.get('job'):
+        job = current_app.extensions['jobs'].get(request.args['job'])
+        if job is None or job['kind'] != 'bulk_assign':
+            flash('Upload not found.', 'danger')
+            return redirect(url_for('main.bulk_assign_patients'))
+    results = job['result']['results'] if job and job['status'] == 'done' else None
+    return render_template('bulk_assign.html', job=job, results=results)
+
+# Route: Bulk Sign Up Users
+@main.route('/bulk_signup', methods=['GET', 'POST'])
+@login_required
+def bulk_signup_users():
+    if current_user.role != 'admin':
+        flash('Access denied.', 'danger')
+        return redirect(url_for('main.login'))
+
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash('Please choose a CSV or JSON file.', 'danger')
+            return redirect(url_for('main.bulk_signup_users'))
 
+        try:
+            results = bulk_signup(parse_upload(upload))
+            created = sum(1 for result in results if result['status'] == 'created')
+            flash(f'{created} of {len(results)} users signed up.', 'success')
+            return render_template('bulk_signup.html', results=results, max_rows=BULK_SIGNUP_MAX_ROWS)
+        except ValueError as e:
+            flash(str(e), 'danger')
+            return redirect(url_for('main.bulk_signup_users'))
+        except Exception:
+            logger.exception("Error bulk signing up users")
+            flash('Failed to process the upload.', 'danger')
+            return redirect(url_for('main.bulk_signup_users'))
+
+    return render_template('bulk_signup.html', results=None, max_rows=BULK_SIGNUP_MAX_ROWS)
 
 # Route: Edit User
-@app.route('/edit_user/<user_id>', methods=['GET', 'POST'])
+@main.route('/edit_user/<user_id>', methods=['GET', 'POST'])
 @login_required
 def edit_user(user_id):
     if current_user.role != 'admin':
         flash('Access denied.', 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
     if request.method == 'POST':
-        email = request.form['email']
+        email = request.form['email'].strip().lower()
         password = request.form['password']
 
         try:
-            # Update user in Firebase Authentication
-            auth.update_user(user_id, email=email)
+            # Update user in Firebase Authentication in a single call
+            changes = {'email': email}
             if password:
-                auth.update_user(user_id, password=password)
+                changes['password'] = password
+            auth.update_user(user_id, **changes)
 
             # Update user in Firestore
             db.collection('users').document(user_id).update({
-                'email': email
+                'email': email,
+                'email_lower': email.lower()
             })
+            invalidate_users(user_id)
+            mark_user_changed(user_id)
+            user_index.update_email(user_id, email)
             flash('User updated successfully.', 'success')
-            return redirect(url_for('admin_dashboard'))
-        except Exception as e:
-            print(f"Error updating user: {e}")
+            return redirect(url_for('main.admin_dashboard'))
+        except Exception:
+            logger.exception("Error updating user")
             flash('Failed to update user.', 'danger')
-            return redirect(url_for('edit_user', user_id=user_id))
+            return redirect(url_for('main.edit_user', user_id=user_id))
 
     try:
-        user_doc = db.collection('users').document(user_id).get()
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
+        user_data, = get_users([user_id])
+        if user_data:
             return render_template('edit_user.html', user=user_data, user_id=user_id)
         else:
             flash('User not found.', 'danger')
-            return redirect(url_for('admin_dashboard'))
-    except Exception as e:
-        print(f"Error fetching user: {e}")
+            return redirect(url_for('main.admin_dashboard'))
+    except Exception:
+        logger.exception("Error fetching user")
         flash('Failed to retrieve user.', 'danger')
-        return redirect(url_for('admin_dashboard'))
+        return redirect(url_for('main.admin_dashboard'))
 
 
 
 # Route: Delete User
-@app.route('/delete_user/<user_id>', methods=['POST'])
+@main.route('/delete_user/<user_id>', methods=['POST'])
 @login_required
 def delete_user(user_id):
     if current_user.role != 'admin':
         flash('Access denied.', 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
     try:
-        # Fetch the user document to check the role
-        user_doc = db.collection('users').document(user_id).get()
-        if not user_doc.exists:
+        user_data, = get_users([user_id])
+        if not user_data:
             flash('User not found.', 'danger')
-            return redirect(url_for('admin_dashboard'))
-
-        user_data = user_doc.to_dict()
-
-        # If the user is a patient, remove their ID from the assigned patients list of any doctor
-        if user_data['role'] == 'patient':
-            doctors = db.collection('users').where('role', '==', 'doctor').stream()
-            for doctor_doc in doctors:
-                doctor_data = doctor_doc.to_dict()
-                assigned_patients_str = doctor_data.get('assigned_patients', '[]')
-                assigned_patients = ast.literal_eval(assigned_patients_str)
-
-                if user_id in assigned_patients:
-                    assigned_patients.remove(user_id)
-                    db.collection('users').document(doctor_doc.id).update({
-                        'assigned_patients': str(assigned_patients)
-                    })
-
-        # Delete user from Firebase Authentication
-        auth.delete_user(user_id)
-        # Delete user from Firestore
-        db.collection('users').document(user_id).delete()
-        flash('User deleted successfully.', 'success')
-        return redirect(url_for('admin_dashboard'))
-    except Exception as e:
-        print(f"Error deleting user: {e}")
+            return redirect(url_for('main.admin_dashboard'))
+
+        # Unlinking the user from their doctors or patients and deleting their PDFs can touch
+        # any amount of data, so it runs as a background job
+        enqueue_job('delete_user', {'user_id': user_id}, key=f'delete_user:{user_id}')
+        flash('User deletion started.', 'success')
+        return redirect(url_for('main.admin_dashboard'))
+    except Exception:
+        logger.exception("Error deleting user")
         flash('Failed to delete user.', 'danger')
-        return redirect(url_for('admin_dashboard'))
+        return redirect(url_for('main.admin_dashboard'))
+
+# Route: User cache statistics
+@main.route('/cache_stats')
+@login_required
+def cache_stats():
+    if current_user.role != 'admin':
+        flash('Access denied.', 'danger')
+        return redirect(url_for('main.login'))
+
+    stats = {'users': user_cache.stats(), 'assignments': assignment_cache.stats()}
+    pdf_cache = current_app.extensions['pdf_cache']
+    if pdf_cache is not None:
+        stats['pdf_cache'] = pdf_cache.stats()
+    return jsonify(stats)
+
+# Route: Background Jobs
+@main.route('/jobs', methods=['GET', 'POST'])
+@login_required
+def job_status():
+    if current_user.role != 'admin':
+        flash('Access denied.', 'danger')
+        return redirect(url_for('main.login'))
+
+    jobs = current_app.extensions['jobs']
+    if request.method == 'POST':
+        kind = request.form.get('kind')
+        if kind not in MAINTENANCE_JOBS:
+            flash('Invalid job.', 'danger')
+            return redirect(url_for('main.job_status'))
+        try:
+            payload = {}
+            if kind in ('migrate_assigned_patients', 'backfill_email_lower'):
+                # Each run gets its own checkpoint, which its retries resume from
+                payload['checkpoint'] = os.path.join(os.path.dirname(os.path.abspath(current_app.config['JOB_DB_PATH'])),
+                                                     f'{kind}.{int(time.time())}.checkpoint.json')
+            enqueue_job(kind, payload, key=kind)
+            flash(f'{MAINTENANCE_JOBS[kind]} started.', 'success')
+        except Exception:
+            logger.exception("Error starting job")
+            flash('Failed to start the job.', 'danger')
+        return redirect(url_for('main.job_status'))
+
+    return render_template('jobs.html', stats=jobs.stats(), jobs=jobs.recent(), maintenance_jobs=MAINTENANCE_JOBS)
+
+# Route: Prometheus metrics
+@main.route('/metrics')
+def metrics():
+    token = current_app.config['METRICS_TOKEN']
+    if not token:
+        return Response('Not Found\n', status=404, mimetype='text/plain')
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    return Response(request_metrics.render(), mimetype='text/plain; version=0.0.4')
 
 # Route: Download PDF
-@app.route('/download_pdf/<pdf_id>')
+@main.route('/download_pdf/<pdf_id>')
 @login_required
 def download_pdf(pdf_id):
     try:
         pdf_record = db.collection('pdfs').document(pdf_id).get()
         if not pdf_record.exists:
             flash('PDF not found.', 'danger')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
 
         pdf_data = pdf_record.to_dict()
-        print(f"PDF Data: {pdf_data}")  # Debugging line
+        logger.debug("PDF Data: %s", pdf_data)
+
+        pdf_file_path = pdf_data['pdf_file']  # Path of the file stored in Firebase Storage
+        # Blobs are named by content hash; the original file name is kept in 'file_name'
+        download_name = pdf_data.get('file_name') or pdf_file_path.split('/')[-1]
+        signed_url_mode = current_app.config['PDF_DOWNLOAD_MODE'] == 'signed_url'
 
         # Access Control
         if current_user.role == 'patient' and pdf_data['patient_id'] != current_user.id:
             flash('Access denied.', 'danger')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
 
+        blob_future = None
         if current_user.role == 'doctor':
-            doctor_doc = db.collection('users').document(current_user.id).get()
-            if not doctor_doc.exists or pdf_data['patient_id'] not in doctor_doc.to_dict().get('assigned_patients', []):
+            # Look the blob up while the doctor's assignment is checked; it is dropped if access is denied
+            if not signed_url_mode:
+                blob_future = submit(get_blob_metadata, pdf_file_path)
+            if not doctor_can_access(current_user.id, pdf_data['patient_id']):
                 flash('Access denied.', 'danger')
-                return redirect(url_for('login'))
+                return redirect(url_for('main.login'))
 
         # Fetch PDF from Firebase Storage
-        pdf_file_path = pdf_data['pdf_file']  # Path of the file stored in Firebase Storage
-        print(f"Fetching PDF from path: {pdf_file_path}")  # Debugging line
-        blob = bucket.blob(pdf_file_path)
-        pdf_content = blob.download_as_bytes()
-
-        return send_file(
-            BytesIO(pdf_content),
-            attachment_filename=pdf_data['pdf_file'].split('/')[-1],  # Only use the filename as the attachment
-            as_attachment=True,
-            mimetype='application/pdf'
-        )
-
-    except Exception as e:
-        print(f"Error downloading PDF: {e}")
+        logger.debug("Fetching PDF from path: %s", pdf_file_path)
+
+        # Redirect to a signed URL so the bytes bypass this worker, falling back to proxying
+        if signed_url_mode:
+            signed_url = get_signed_pdf_url(pdf_id, current_user.id, pdf_file_path, download_name)
+            if signed_url:
+                return redirect(signed_url)
+
+        blob = blob_future.result() if blob_future is not None else get_blob_metadata(pdf_file_path)
+        if blob is None:
+            flash('PDF file not found.', 'danger')
+            return redirect(url_for('main.login'))
+
+        # A browser that already has this generation of the PDF gets a 304 without the blob being read
+        response = not_modified(pdf_etag(blob), blob.updated)
+        if response is not None:
+            return response
+
+        # Serve hot PDFs from the local disk cache; send_file lets the server use sendfile
+        pdf_cache = current_app.extensions['pdf_cache']
+        if pdf_cache is not None:
+            cached_path = pdf_cache.fetch(blob)
+            if cached_path is not None:
+                try:
+                    return send_file(cached_path, mimetype='application/pdf', as_attachment=True,
+                                     download_name=download_name, conditional=True,
+                                     etag=pdf_etag(blob), last_modified=blob.updated)
+                except FileNotFoundError:
+                    # Another process evicted the file before it was opened; stream it from Storage instead
+                    logger.debug("Cached copy of %s was evicted; streaming it", pdf_file_path)
+
+        return send_blob(blob, download_name)
+
+    except Exception:
+        logger.exception("Error downloading PDF")
         flash('Failed to download PDF.', 'danger')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
+
+def create_app(config=None, db_client=None, storage_bucket=None, auth_client=None):
+    """Create and configure the Flask app.
+
+    The Firestore client, Storage bucket and Auth client can be injected (for
+    example the in-memory fakes in fakes.py); any that are not are created
+    from the Firebase Admin SDK, using FIREBASE_CREDENTIALS and
+    FIREBASE_BUCKET, the first time a request needs them. Nothing here talks
+    to Firebase; call warm_up() to connect ahead of the first request. Each
+    app has its own clients, caches and metrics in app.extensions, so several
+    apps can live in one process.
+    """
+    app = Flask(__name__)
+    app.config.update(default_config())
+    app.config.update(config or {})
+
+    credentials_path, bucket_name = app.config['FIREBASE_CREDENTIALS'], app.config['FIREBASE_BUCKET']
+
+    def create_clients():
+        if db_client is not None and storage_bucket is not None and auth_client is not None:
+            return db_client, storage_bucket, auth_client
+        firebase_app = get_firebase_app(credentials_path, bucket_name)
+        return (db_client or firestore.client(firebase_app),
+                storage_bucket or storage.bucket(app=firebase_app),
+                auth_client or firebase_auth.Client(firebase_app))
+    clients = FirebaseClients()
+    clients.configure(create_clients)
+    app.extensions['firebase'] = clients
+
+    app.extensions['request_metrics'] = MetricsRegistry()
+    app.extensions['user_cache'] = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+    app.extensions['assignment_cache'] = TTLCache(ASSIGNMENT_CACHE_SIZE, ASSIGNMENT_CACHE_TTL)
+    app.extensions['changed_users'] = TTLCache(USER_CACHE_SIZE, SESSION_REVALIDATE)
+    app.extensions['user_index'] = UserPrefixIndex()
+    app.extensions['blob_metadata_cache'] = TTLCache(BLOB_METADATA_CACHE_SIZE, app.config['PDF_METADATA_TTL'])
+    app.extensions['signed_url_cache'] = TTLCache(SIGNED_URL_CACHE_SIZE,
+                                                  app.config['SIGNED_URL_TTL'] - SIGNED_URL_EXPIRY_MARGIN)
+    app.extensions['pdf_cache'] = (BlobDiskCache(app.config['PDF_CACHE_DIR'], app.config['PDF_CACHE_MAX_BYTES'])
+                                   if app.config['PDF_CACHE_DIR'] else None)
+    app.extensions['jobs'] = JobQueue(app.config['JOB_DB_PATH'], JOB_HANDLERS, app.config['JOB_WORKERS'],
+                                      context=app.app_context)
+
+    login_manager = LoginManager()
+    login_manager.login_view = 'main.login'
+    login_manager.user_loader(load_user)
+    login_manager.init_app(app)
+    app.register_blueprint(main)
+    apps.add(app)
+    return app
+
+def warm_up(app):
+    """Create this process's Firebase clients for app and open their connections before the first request.
+
+    Optional; meant to be called once per worker from a server hook (see
+    gunicorn.conf.py). Also starts loading the typeahead index.
+    """
+    started = time.perf_counter()
+    with app.app_context():
+        try:
+            db.collection('users').document('warm_up').get()
+            bucket.get_blob('warm_up')
+        except Exception:
+            logger.exception("Error warming up Firebase connections")
+        refresh_user_index()
+    logger.info("Firebase connections warmed up in %.3fs", time.perf_counter() - started)
+
+def reset_after_fork():
+    """Drop state a forked worker must not share with its parent: Firebase clients and thread pools."""
+    global backend_pool
+    backend_pool = ThreadPoolExecutor(max_workers=BACKEND_WORKERS)
+    for app in list(apps):
+        app.extensions['firebase'].reset()
+        app.extensions['user_index'].refreshing = False
+
+os.register_at_fork(after_in_child=reset_after_fork)
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
+    create_app().run(debug=True)
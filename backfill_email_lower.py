@@ -0,0 +1,58 @@
+from google.cloud.firestore_v1.field_path import FieldPath
+from firebase_scripts import initialize_firebase, load_checkpoint, save_checkpoint
+from migrate_assigned_patients import WriteBuffer
+import argparse
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Users read per page; each page is checkpointed once its writes are committed
+PAGE_SIZE = 500
+
+def backfill_email_lower(db, checkpoint_path, page_size=PAGE_SIZE, dry_run=False):
+    """Add 'email_lower', the lowercased copy of 'email' that the admin search queries, to every user.
+
+    Progress is checkpointed after every page so an interrupted run resumes
+    where it stopped; documents that already have the right value are not
+    rewritten. Returns the number of documents updated.
+    """
+    checkpoint = load_checkpoint(checkpoint_path, {'last_id': None})
+    writes = WriteBuffer(db, dry_run)
+    query = (db.collection('users')
+             .select(['email', 'email_lower'])
+             .order_by(FieldPath.document_id())
+             .limit(page_size))
+
+    while True:
+        last_id = checkpoint['last_id']
+        page_query = query.start_after({FieldPath.document_id(): last_id}) if last_id else query
+        page = list(page_query.stream())
+        if not page:
+            break
+
+        for doc in page:
+            user_data = doc.to_dict()
+            email = user_data.get('email')
+            if isinstance(email, str) and user_data.get('email_lower') != email.lower():
+                writes.update(doc.reference, {'email_lower': email.lower()})
+
+        writes.flush()
+        checkpoint['last_id'] = page[-1].id
+        if not dry_run:
+            save_checkpoint(checkpoint_path, checkpoint)
+        logger.info("Users backfilled up to %s (%d writes)", checkpoint['last_id'], writes.written)
+    return writes.written
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add the lowercased 'email_lower' field to every user document.")
+    parser.add_argument('--credentials', required=True, help="Path to the service account key file")
+    parser.add_argument('--checkpoint', default='backfill_email_lower.checkpoint.json',
+                        help="File used to resume an interrupted backfill")
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE)
+    parser.add_argument('--dry-run', action='store_true', help="Report the writes without committing them")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    _, db = initialize_firebase(args.credentials)
+    updated = backfill_email_lower(db, args.checkpoint, args.page_size, args.dry_run)
+    print(f"{updated} users updated.")
@@ -0,0 +1,129 @@
+from firebase_admin import firestore
+from google.api_core.exceptions import NotFound
+from google.cloud.firestore_v1.field_path import FieldPath
+from concurrent.futures import ThreadPoolExecutor
+from firebase_scripts import BATCH_WRITE_LIMIT, initialize_firebase, load_checkpoint, save_checkpoint
+from uploads import hash_stream, HASH_CHUNK_SIZE
+from rebuild_pdf_summaries import check_summaries
+import argparse
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Each PDF needs two writes (its 'pdfs' document and its hash index entry)
+PAGE_SIZE = BATCH_WRITE_LIMIT // 2
+HASH_WORKERS = 8
+
+def hash_blob(bucket, pdf_file):
+    """Return the SHA-256 of a stored blob, streamed in chunks rather than downloaded whole.
+
+    Returns None if the blob does not exist.
+    """
+    try:
+        with bucket.blob(pdf_file).open('rb', chunk_size=HASH_CHUNK_SIZE) as reader:
+            return hash_stream(reader)
+    except NotFound:
+        return None
+
+def hash_missing(bucket, db, checkpoint_path, page_size=PAGE_SIZE, workers=HASH_WORKERS):
+    """Hash every 'pdfs' blob that has no sha256 yet and add it to the hash index.
+
+    Progress is checkpointed after every page so an interrupted run resumes
+    where it stopped. Records whose blob is missing are reported and left
+    unhashed. Returns their 'pdfs' document IDs.
+    """
+    checkpoint = load_checkpoint(checkpoint_path, {'last_id': None})
+    not_found = []
+    query = db.collection('pdfs').order_by(FieldPath.document_id()).limit(page_size)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            last_id = checkpoint['last_id']
+            page_query = query.start_after({FieldPath.document_id(): last_id}) if last_id else query
+            page = list(page_query.stream())
+            if not page:
+                break
+
+            pdfs = [(doc, doc.to_dict()) for doc in page]
+            missing = [(doc, pdf_data) for doc, pdf_data in pdfs if not pdf_data.get('sha256')]
+            hashes = pool.map(lambda item: hash_blob(bucket, item[1]['pdf_file']), missing)
+
+            batch = db.batch()
+            hashed = 0
+            for (doc, pdf_data), sha256 in zip(missing, hashes):
+                if sha256 is None:
+                    not_found.append(doc.id)
+                    logger.warning("Blob %s for PDF %s not found; skipped", pdf_data['pdf_file'], doc.id)
+                    continue
+                batch.update(doc.reference, {'sha256': sha256})
+                batch.set(db.collection('pdf_hashes').document(sha256), {
+                    'pdf_file': pdf_data['pdf_file'],
+                    'pdf_url': pdf_data['pdf_url'],
+                    'patient_ids': firestore.ArrayUnion([pdf_data['patient_id']])
+                }, merge=True)
+                hashed += 1
+            batch.commit()
+
+            checkpoint['last_id'] = page[-1].id
+            save_checkpoint(checkpoint_path, checkpoint)
+            logger.info("Hashed %d PDFs up to %s", hashed, checkpoint['last_id'])
+    return not_found
+
+def find_duplicates(db):
+    """Find 'pdfs' documents with the same content as an earlier upload for the same patient.
+
+    Returns a list of (patient_id, kept pdf_id, duplicate pdf_id) tuples; the
+    oldest upload of each report is the one kept.
+    """
+    pdfs = db.collection('pdfs').select(['patient_id', 'sha256', 'upload_date']).stream()
+    by_content = {}
+    for doc in pdfs:
+        pdf_data = doc.to_dict()
+        if pdf_data.get('sha256'):
+            key = (pdf_data['patient_id'], pdf_data['sha256'])
+            by_content.setdefault(key, []).append((pdf_data.get('upload_date'), doc.id))
+
+    duplicates = []
+    for (patient_id, _), uploads in by_content.items():
+        if len(uploads) < 2:
+            continue
+        uploads.sort(key=lambda upload: str(upload[0]))
+        kept_id = uploads[0][1]
+        for _, doc_id in uploads[1:]:
+            duplicates.append((patient_id, kept_id, doc_id))
+            logger.info("Duplicate report for patient %s: %s (keeping %s)", patient_id, doc_id, kept_id)
+    return duplicates
+
+def delete_duplicates(db, duplicates):
+    """Delete the duplicate 'pdfs' documents and rebuild their patients' summaries.
+
+    Blobs are left alone, since the kept document may share them.
+    """
+    for i in range(0, len(duplicates), BATCH_WRITE_LIMIT):
+        batch = db.batch()
+        for _, _, doc_id in duplicates[i:i + BATCH_WRITE_LIMIT]:
+            batch.delete(db.collection('pdfs').document(doc_id))
+        batch.commit()
+    logger.info("Deleted %d duplicate PDF records.", len(duplicates))
+    check_summaries(db, sorted({patient_id for patient_id, _, _ in duplicates}), fix=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hash existing PDF blobs and find duplicate reports.")
+    parser.add_argument('--credentials', required=True, help="Path to the service account key file")
+    parser.add_argument('--bucket', required=True, help="Firebase Storage bucket name")
+    parser.add_argument('--checkpoint', default='backfill_pdf_hashes.checkpoint.json',
+                        help="File used to resume an interrupted run")
+    parser.add_argument('--workers', type=int, default=HASH_WORKERS)
+    parser.add_argument('--delete-duplicates', action='store_true',
+                        help="Delete duplicate 'pdfs' documents found by this run")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    bucket, db = initialize_firebase(args.credentials, args.bucket)
+    not_found = hash_missing(bucket, db, args.checkpoint, workers=args.workers)
+    if not_found:
+        print(f"{len(not_found)} PDF records point at missing blobs.")
+    duplicates = find_duplicates(db)
+    print(f"Found {len(duplicates)} duplicate PDF records.")
+    if args.delete_duplicates:
+        delete_duplicates(db, duplicates)
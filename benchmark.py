@@ -0,0 +1,441 @@
+"""Benchmark the main routes against the in-memory fakes in fakes.py.
+
+Seeds a fake project with the given numbers of patients, then times each
+scenario through the Flask test client and reports latency percentiles and
+backend round trips per request. No Firebase project is needed.
+
+    python benchmark.py --sizes 10,1000,100000 --latency 0.005 --json results.json
+    python benchmark.py --memory 1,10,50
+    python benchmark.py --bulk 1000 --latency 0.005
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import argparse
+import io
+import json
+import math
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from flask import send_file
+
+import app as medic
+import fakes
+from uploads import merge_summary, summary_entry
+
+PATIENTS_PER_DOCTOR = 500
+PDFS_PER_PATIENT = 5
+PDF_SIZE = 256 * 1024
+BULK_ROWS = 1000
+MEMORY_PDF_SIZE = 4 * 1024 * 1024
+
+def seed(db, bucket, auth, patients, iterations, patients_per_doctor=PATIENTS_PER_DOCTOR,
+         pdfs_per_patient=PDFS_PER_PATIENT, pdf_size=PDF_SIZE):
+    """Fill the fakes with an admin, doctors, patients and their PDFs.
+
+    Besides `patients` regular patients, `iterations` extra patients assigned
+    to the first doctor are created for the delete_user scenario. All PDFs
+    share one blob payload. Returns a dict of IDs the scenarios use.
+    """
+    content = b'%PDF-1.4\n' + bytes(pdf_size - 9)
+    auth.add_user('admin', 'admin@example.com', 'password', {'role': 'admin'})
+    db.put('users/admin', {'email': 'admin@example.com', 'email_lower': 'admin@example.com', 'role': 'admin'})
+
+    doctor_ids = [f'doctor-{i:05d}' for i in range(max(1, math.ceil(patients / patients_per_doctor)))]
+    assigned = {doctor_id: [] for doctor_id in doctor_ids}
+    patient_ids = [f'patient-{i:07d}' for i in range(patients)]
+    victim_ids = [f'victim-{i:07d}' for i in range(iterations)]
+    started = datetime(2024, 1, 1)
+
+    for i, patient_id in enumerate(patient_ids + victim_ids):
+        doctor_id = doctor_ids[i // patients_per_doctor] if i < patients else doctor_ids[0]
+        assigned[doctor_id].append(patient_id)
+        email = f'{patient_id}@example.com'
+        auth.add_user(patient_id, email, 'password', {'role': 'patient'})
+        db.put(f'users/{patient_id}', {'email': email, 'email_lower': email, 'role': 'patient',
+                                       'assigned_doctors': [doctor_id], 'doctors_indexed': True})
+        entries = []
+        for j in range(pdfs_per_patient):
+            pdf_file = f'pdfs/{patient_id}/report-{j}.pdf'
+            pdf_data = {
+                'patient_id': patient_id,
+                'pdf_file': pdf_file,
+                'pdf_url': f'https://storage.googleapis.com/{bucket.name}/{pdf_file}',
+                'upload_date': started + timedelta(minutes=i * pdfs_per_patient + j)
+            }
+            bucket.put(pdf_file, content)
+            db.put(f'pdfs/{patient_id}-{j}', pdf_data)
+            entries.append(summary_entry(f'{patient_id}-{j}', pdf_data))
+        if entries:
+            db.put(f'pdf_summaries/{patient_id}', merge_summary(None, entries))
+
+    for doctor_id in doctor_ids:
+        email = f'{doctor_id}@example.com'
+        auth.add_user(doctor_id, email, 'password', {'role': 'doctor'})
+        db.put(f'users/{doctor_id}', {'email': email, 'email_lower': email, 'role': 'doctor',
+                                      'assigned_patients': assigned[doctor_id]})
+
+    # A spare doctor with no patients, for assign/unassign and bulk assignment
+    auth.add_user('doctor-spare', 'doctor-spare@example.com', 'password', {'role': 'doctor'})
+    db.put('users/doctor-spare', {'email': 'doctor-spare@example.com', 'email_lower': 'doctor-spare@example.com',
+                                  'role': 'doctor', 'assigned_patients': []})
+
+    return {
+        'doctor_id': doctor_ids[0],
+        'patient_id': patient_ids[0],
+        'patient_ids': patient_ids,
+        'victim_ids': victim_ids,
+        'pdf_id': f'{patient_ids[0]}-0'
+    }
+
+def bulk_assign_upload(patient_ids, doctor_id='doctor-spare'):
+    rows = ['doctor_id,patient_id'] + [f'{doctor_id},{patient_id}' for patient_id in patient_ids[:BULK_ROWS]]
+    return {'file': (io.BytesIO('\n'.join(rows).encode()), 'assignments.csv')}
+
+def bulk_signup_upload(emails):
+    rows = ['email,password,role'] + [f'{email},password,patient' for email in emails]
+    return {'file': (io.BytesIO('\n'.join(rows).encode()), 'users.csv')}
+
+# name -> (role, method, function of (iteration, ids) returning (path, form data), expected status, config)
+SCENARIOS = {
+    'login': (None, 'POST', lambda i, ids: ('/login', {'email': f"{ids['patient_id']}@example.com",
+                                                       'password': 'password'}), 302, {}),
+    'patient_dashboard': ('patient', 'GET', lambda i, ids: ('/patient_dashboard', None), 200, {}),
+    'doctor_dashboard': ('doctor', 'GET', lambda i, ids: ('/doctor_dashboard', None), 200, {}),
+    'view_patient_pdfs': ('doctor', 'GET', lambda i, ids: (f"/view_patient_pdfs/{ids['patient_id']}", None), 200, {}),
+    'admin_dashboard': ('admin', 'GET', lambda i, ids: ('/admin_dashboard', None), 200, {}),
+    'assign_unassign': ('admin', 'POST', lambda i, ids: ('/assign_unassign_patient', {
+        'doctor_id': 'doctor-spare', 'patient_id': ids['patient_id'],
+        'action': 'assign' if i % 2 == 0 else 'unassign'}), 302, {}),
+    'delete_user': ('admin', 'POST', lambda i, ids: (f"/delete_user/{ids['victim_ids'][i]}", None), 302, {}),
+    'download_pdf': ('patient', 'GET', lambda i, ids: (f"/download_pdf/{ids['pdf_id']}", None), 200,
+                     {'PDF_DOWNLOAD_MODE': 'proxy'}),
+    'download_pdf_doctor': ('doctor', 'GET', lambda i, ids: (f"/download_pdf/{ids['pdf_id']}", None), 200,
+                            {'PDF_DOWNLOAD_MODE': 'proxy'}),
+    'download_pdf_signed_url': ('patient', 'GET', lambda i, ids: (f"/download_pdf/{ids['pdf_id']}", None), 302,
+                                {'PDF_DOWNLOAD_MODE': 'signed_url'}),
+    'bulk_assign': ('admin', 'POST', lambda i, ids: ('/bulk_assign', bulk_assign_upload(ids['patient_ids'])), 302, {}),
+    'patient_dashboard_revalidate': ('patient', 'GET', lambda i, ids: ('/patient_dashboard', None), 304, {}),
+    'download_pdf_revalidate': ('patient', 'GET', lambda i, ids: (f"/download_pdf/{ids['pdf_id']}", None), 304,
+                                {'PDF_DOWNLOAD_MODE': 'proxy'}),
+}
+
+def login(flask_app, role, ids):
+    user_id = {'patient': ids['patient_id'], 'doctor': ids['doctor_id'], 'admin': 'admin'}[role]
+    client = flask_app.test_client()
+    response = client.post('/login', data={'email': f'{user_id}@example.com', 'password': 'password'})
+    if response.status_code != 302 or response.location.endswith('/login'):
+        raise RuntimeError(f'Could not log in as {role}')
+    return client
+
+def check_flashes(client):
+    """Fail if the request flashed an error, since routes report failures by flash and redirect."""
+    with client.session_transaction() as session:
+        errors = [message for category, message in session.pop('_flashes', []) if category == 'danger']
+    if errors:
+        raise RuntimeError('; '.join(errors))
+
+def run_scenario(flask_app, name, ids, iterations, concurrency, backends, cold_cache=False):
+    """Time a scenario's requests, then wait for the background jobs they queued.
+
+    Backend calls and documents per request are counted once those jobs have
+    finished, so they include the work requests hand off to the queue. The
+    time from the last response until the queue is idle is reported
+    separately as jobs_ms.
+    """
+    role, method, build, expected_status, config = SCENARIOS[name]
+    flask_app.config.update(config)
+    clients = [login(flask_app, role, ids) if role else flask_app.test_client() for _ in range(concurrency)]
+    headers = {}
+    if method == 'GET':
+        # One untimed request compiles templates and builds the fake's query indexes
+        path, data = build(0, ids)
+        response = clients[0].get(path)
+        response.get_data()
+        check_flashes(clients[0])
+        if expected_status == 304:
+            # Revalidation scenarios send back the ETag a browser would have cached
+            headers['If-None-Match'] = response.headers['ETag']
+    calls_before = {service: backend.total_calls() for service, backend in backends.items()}
+    documents_before = backends['firestore'].documents_read
+    timings = []
+    lock = threading.Lock()
+
+    def worker(worker_index):
+        client = clients[worker_index]
+        for i in range(worker_index, iterations, concurrency):
+            path, data = build(i, ids)
+            if cold_cache:
+                flask_app.extensions['user_cache'].clear()
+                flask_app.extensions['assignment_cache'].clear()
+            started = time.perf_counter()
+            response = client.open(path, method=method, data=data, headers=headers)
+            response.get_data()  # Streamed bodies are only produced when read
+            elapsed = time.perf_counter() - started
+            if response.status_code != expected_status:
+                raise RuntimeError(f'{name}: expected {expected_status}, got {response.status_code}')
+            check_flashes(client)
+            with lock:
+                timings.append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(worker, index) for index in range(concurrency)]:
+            future.result()
+    wall_time = time.perf_counter() - started
+
+    jobs = flask_app.extensions['jobs']
+    jobs.wait_idle()
+    jobs_time = time.perf_counter() - started - wall_time
+    if jobs.stats().get('failed'):
+        raise RuntimeError(f'{name}: background jobs failed')
+
+    timings.sort()
+    result = {
+        'scenario': name,
+        'iterations': iterations,
+        'concurrency': concurrency,
+        'mean_ms': statistics.mean(timings) * 1000,
+        'p50_ms': timings[len(timings) // 2] * 1000,
+        'p95_ms': timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000,
+        'requests_per_sec': iterations / wall_time,
+        'jobs_ms': jobs_time * 1000,
+        'firestore_docs': (backends['firestore'].documents_read - documents_before) / iterations
+    }
+    for service, backend in backends.items():
+        result[f'{service}_calls'] = (backend.total_calls() - calls_before[service]) / iterations
+    return result
+
+def create_benchmark_app(backends):
+    """Create the app on the fakes, with no PDF disk cache and a job queue in a temporary directory."""
+    job_dir = tempfile.mkdtemp(prefix='medic-jobs-')
+    return medic.create_app({'SECRET_KEY': 'benchmark', 'PDF_CACHE_DIR': '', 'SERVER_TIMING': False,
+                             'JOB_DB_PATH': os.path.join(job_dir, 'jobs.sqlite3')},
+                            backends['firestore'], backends['storage'], backends['auth'])
+
+def benchmark_size(patients, scenarios, iterations, concurrency, latency, cold_cache=False):
+    backends = {'firestore': fakes.Client(), 'storage': fakes.Bucket(), 'auth': fakes.FakeAuth()}
+    started = time.perf_counter()
+    ids = seed(backends['firestore'], backends['storage'], backends['auth'], patients, iterations)
+    print(f"Seeded {patients} patients in {time.perf_counter() - started:.1f}s")
+
+    flask_app = create_benchmark_app(backends)
+    # Let the typeahead index finish warming so its reads are not counted against a scenario
+    medic.warm_up(flask_app)
+    while flask_app.extensions['user_index'].loaded_at is None:
+        time.sleep(0.01)
+    for backend in backends.values():
+        backend.latency = latency
+
+    results = []
+    for name in scenarios:
+        result = run_scenario(flask_app, name, ids, iterations, concurrency, backends, cold_cache)
+        result['patients'] = patients
+        results.append(result)
+    return results
+
+def download_memory(mode, parallel, pdf_size=MEMORY_PDF_SIZE):
+    """Run `parallel` simultaneous downloads of one PDF and return the peak memory they allocated, in bytes.
+
+    'streamed' goes through the download_pdf route. 'buffered' is the path it
+    replaced: download_as_bytes() into a BytesIO, then send_file. Each
+    download holds its response open until all of them have started, so
+    their buffers are alive at the same time.
+    """
+    backends = {'firestore': fakes.Client(), 'storage': fakes.Bucket(), 'auth': fakes.FakeAuth()}
+    ids = seed(backends['firestore'], backends['storage'], backends['auth'], 1, 0, pdfs_per_patient=1,
+               pdf_size=pdf_size)
+    flask_app = create_benchmark_app(backends)
+    flask_app.config['PDF_DOWNLOAD_MODE'] = 'proxy'
+    path = f"/download_pdf/{ids['pdf_id']}"
+    pdf_file = f"pdfs/{ids['patient_id']}/report-0.pdf"
+    clients = [login(flask_app, 'patient', ids) for _ in range(parallel)]
+    # Loads the route and the blob metadata cache without reading the whole body
+    clients[0].get(path, headers={'Range': 'bytes=0-0'}).get_data()
+    all_started = threading.Barrier(parallel)
+
+    def streamed(client):
+        response = client.get(path, buffered=False)
+        all_started.wait()
+        for _ in response.response:
+            pass
+        response.close()
+
+    def buffered(client):
+        with flask_app.test_request_context(path):
+            file_stream = io.BytesIO(medic.bucket.blob(pdf_file).download_as_bytes())
+            response = send_file(file_stream, mimetype='application/pdf', as_attachment=True,
+                                 download_name='report-0.pdf')
+            all_started.wait()
+            for _ in response.response:
+                pass
+            response.close()
+
+    download = {'streamed': streamed, 'buffered': buffered}[mode]
+    # tracemalloc sees every Python allocation, which is where response buffers live,
+    # and unlike peak RSS it starts from zero for each measurement
+    tracemalloc.start()
+    try:
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            for future in [pool.submit(download, client) for client in clients]:
+                future.result()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def measure_download_memory(levels):
+    """Compare the peak memory of buffered and streamed PDF downloads at each level of parallelism."""
+    print(f"{MEMORY_PDF_SIZE / 2 ** 20:.0f} MiB PDF, peak memory allocated by the downloads:")
+    print(f"{'parallel':>9} {'buffered MiB':>13} {'streamed MiB':>13}")
+    for parallel in levels:
+        peak = {mode: download_memory(mode, parallel) / 2 ** 20 for mode in ('buffered', 'streamed')}
+        print(f"{parallel:>9} {peak['buffered']:>13.1f} {peak['streamed']:>13.1f}")
+
+def measure_bulk(rows, latency):
+    """Compare one request per row against one bulk upload, for assigning patients and for signing up users.
+
+    Assigning loops over /assign_unassign_patient and uploads to /bulk_assign,
+    whose time includes running the queued job. Signing up loops over
+    /signup_patient and uploads to /bulk_signup, in as many uploads as its row
+    limit needs. Reports time and backend calls per 1,000 rows.
+    """
+    backends = {'firestore': fakes.Client(), 'storage': fakes.Bucket(), 'auth': fakes.FakeAuth()}
+    ids = seed(backends['firestore'], backends['storage'], backends['auth'], rows, 0, pdfs_per_patient=0)
+    # A second doctor with no patients, so the bulk upload assigns as many patients as the loop
+    backends['auth'].add_user('doctor-bulk', 'doctor-bulk@example.com', 'password', {'role': 'doctor'})
+    backends['firestore'].put('users/doctor-bulk', {'email': 'doctor-bulk@example.com',
+                                                    'email_lower': 'doctor-bulk@example.com', 'role': 'doctor',
+                                                    'assigned_patients': []})
+    flask_app = create_benchmark_app(backends)
+    jobs = flask_app.extensions['jobs']
+    client = login(flask_app, 'admin', ids)
+    for backend in backends.values():
+        backend.latency = latency
+
+    def post(path, data, expected_status):
+        response = client.post(path, data=data)
+        if response.status_code != expected_status:
+            raise RuntimeError(f'{path}: expected {expected_status}, got {response.status_code}')
+        check_flashes(client)
+
+    def assign_loop():
+        for patient_id in ids['patient_ids']:
+            post('/assign_unassign_patient', {'doctor_id': 'doctor-spare', 'patient_id': patient_id,
+                                              'action': 'assign'}, 302)
+
+    def assign_bulk():
+        post('/bulk_assign', bulk_assign_upload(ids['patient_ids'], 'doctor-bulk'), 302)
+        jobs.wait_idle()
+
+    def signup_loop():
+        for i in range(rows):
+            post('/signup_patient', {'email': f'loop-{i:07d}@example.com', 'password': 'password'}, 302)
+
+    def signup_bulk():
+        # Sign-up uploads are capped at BULK_SIGNUP_MAX_ROWS, so larger runs take several
+        emails = [f'bulk-{i:07d}@example.com' for i in range(rows)]
+        for i in range(0, rows, medic.BULK_SIGNUP_MAX_ROWS):
+            post('/bulk_signup', bulk_signup_upload(emails[i:i + medic.BULK_SIGNUP_MAX_ROWS]), 200)
+
+    def measure(operation):
+        calls_before = sum(backend.total_calls() for backend in backends.values())
+        started = time.perf_counter()
+        operation()
+        elapsed = time.perf_counter() - started
+        calls = sum(backend.total_calls() for backend in backends.values()) - calls_before
+        return elapsed * 1000 * 1000 / rows, calls * 1000 / rows
+
+    print(f"{rows} rows, {latency * 1000:.1f} ms per backend round trip, per 1,000 rows:")
+    print(f"{'operation':<10} {'loop ms':>10} {'bulk ms':>10} {'loop calls':>11} {'bulk calls':>11}")
+    for name, loop, bulk in (('assign', assign_loop, assign_bulk), ('signup', signup_loop, signup_bulk)):
+        (loop_ms, loop_calls), (bulk_ms, bulk_calls) = measure(loop), measure(bulk)
+        print(f"{name:<10} {loop_ms:>10.1f} {bulk_ms:>10.1f} {loop_calls:>11.0f} {bulk_calls:>11.0f}")
+
+    for doctor_id in ('doctor-spare', 'doctor-bulk'):
+        assigned = backends['firestore'].document(f'users/{doctor_id}').get().to_dict()['assigned_patients']
+        if len(assigned) != rows:
+            raise RuntimeError(f'{doctor_id}: expected {rows} assigned patients, got {len(assigned)}')
+
+# Run in a fresh interpreter so module imports are cold, as in a new worker
+STARTUP_SCRIPT = """
+import time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+flask_app = app.create_app()
+created = time.perf_counter()
+flask_app.test_client().get('/login')
+print(imported - started, created - imported, time.perf_counter() - created)
+"""
+
+def measure_startup(runs):
+    """Time import, create_app and the first response (the login page) in fresh processes.
+
+    Uses the real Firebase Admin SDK configuration from the environment.
+    """
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        samples.append([float(value) for value in output.split()[-3:]])
+    for i, label in enumerate(('import', 'create_app', 'first response')):
+        print(f"{label:>15}: {statistics.median(sample[i] for sample in samples) * 1000:8.1f} ms (median of {runs})")
+    print(f"{'total':>15}: {statistics.median(sum(sample) for sample in samples) * 1000:8.1f} ms")
+
+def print_results(results):
+    header = (f"{'patients':>9} {'scenario':<28} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'req/s':>8} "
+              f"{'jobs ms':>9} {'fs calls':>9} {'fs docs':>9} {'gcs calls':>9} {'auth':>6}")
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f"{r['patients']:>9} {r['scenario']:<28} {r['mean_ms']:>9.2f} {r['p50_ms']:>9.2f} {r['p95_ms']:>9.2f} "
+              f"{r['requests_per_sec']:>8.1f} {r['jobs_ms']:>9.1f} {r['firestore_calls']:>9.1f} {r['firestore_docs']:>9.1f} "
+              f"{r['storage_calls']:>9.1f} {r['auth_calls']:>6.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the app's routes against in-memory Firebase fakes.")
+    parser.add_argument('--sizes', default='10,1000', help="Comma-separated patient counts to seed")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help="Comma-separated scenarios to run")
+    parser.add_argument('--iterations', type=int, default=50, help="Requests per scenario")
+    parser.add_argument('--concurrency', type=int, default=1, help="Concurrent clients per scenario")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to every backend round trip")
+    parser.add_argument('--cold-cache', action='store_true', help="Clear the user and assignment caches before every request")
+    parser.add_argument('--json', help="Also write the results to this file")
+    parser.add_argument('--startup', type=int, metavar='RUNS',
+                        help="Measure import-to-first-response time over RUNS fresh processes instead")
+    parser.add_argument('--memory', metavar='LEVELS',
+                        help="Compare peak memory of buffered and streamed PDF downloads at these comma-separated "
+                             "numbers of parallel downloads instead")
+    parser.add_argument('--bulk', type=int, metavar='ROWS',
+                        help="Compare per-row requests with bulk uploads of ROWS rows instead")
+    args = parser.parse_args()
+
+    if args.startup:
+        measure_startup(args.startup)
+        sys.exit()
+    if args.memory:
+        measure_download_memory([int(level) for level in args.memory.split(',')])
+        sys.exit()
+    if args.bulk:
+        measure_bulk(args.bulk, args.latency)
+        sys.exit()
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(unknown)}")
+
+    results = []
+    for size in args.sizes.split(','):
+        results += benchmark_size(int(size), scenarios, args.iterations, args.concurrency, args.latency,
+                                  args.cold_cache)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,126 @@
+from collections import OrderedDict
+import hashlib
+import os
+import tempfile
+import threading
+
+class BlobDiskCache:
+    """On-disk LRU cache of Storage blobs, keyed by blob path and generation.
+
+    A new generation of a blob gets a new cache key, so cached files never
+    need to be invalidated; stale ones simply age out. Files are written to a
+    temporary name and renamed into place, so readers never see a partial
+    file. Several worker processes may share the directory: each keeps its own
+    LRU order and size total, and a file evicted by another process is just
+    treated as a miss. max_bytes is therefore a per-process cap; N workers
+    sharing a directory can fill it with up to N * max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # filename -> size, least recently used first
+        self.total_bytes = 0
+        self.downloads = {}  # filename -> lock held while that blob is being downloaded
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+        os.makedirs(directory, exist_ok=True)
+        files = []
+        for filename in os.listdir(directory):
+            path = os.path.join(directory, filename)
+            if filename.endswith('.pdf') and os.path.isfile(path):
+                stat = os.stat(path)
+                files.append((stat.st_atime, filename, stat.st_size))
+        for _, filename, size in sorted(files):
+            self.entries[filename] = size
+            self.total_bytes += size
+        self._evict()
+
+    def _filename(self, blob_path, generation):
+        return hashlib.sha256(f"{blob_path}#{generation}".encode()).hexdigest() + '.pdf'
+
+    def _lookup(self, filename):
+        path = os.path.join(self.directory, filename)
+        with self.lock:
+            if filename not in self.entries:
+                return None
+            if not os.path.exists(path):
+                self.total_bytes -= self.entries.pop(filename)
+                return None
+            self.entries.move_to_end(filename)
+            self.hits += 1
+            self.bytes_saved += self.entries[filename]
+            return path
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            filename, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
+
+    def fetch(self, blob):
+        """Return a local path holding the contents of blob, downloading it on a miss.
+
+        blob must have its metadata loaded (name, generation and size).
+        Returns None for blobs too large to cache.
+        """
+        if blob.size is None or blob.size > self.max_bytes:
+            return None
+
+        filename = self._filename(blob.name, blob.generation)
+        path = self._lookup(filename)
+        if path is not None:
+            return path
+
+        # Only one request downloads a given blob; the others wait and then hit the cache
+        with self.lock:
+            download_lock = self.downloads.setdefault(filename, threading.Lock())
+        with download_lock:
+            path = self._lookup(filename)
+            if path is not None:
+                return path
+
+            with self.lock:
+                self.misses += 1
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    blob.download_to_file(f)
+                path = os.path.join(self.directory, filename)
+                os.replace(tmp_path, path)
+                size = os.path.getsize(path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                with self.lock:
+                    self.downloads.pop(filename, None)
+                raise
+
+            # Registering the file and releasing the download slot in one step means a
+            # request arriving in between finds the entry instead of downloading again
+            with self.lock:
+                if filename not in self.entries:
+                    self.entries[filename] = size
+                    self.total_bytes += size
+                self.entries.move_to_end(filename)
+                self.downloads.pop(filename, None)
+                self._evict()
+            return path
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'bytes_saved': self.bytes_saved,
+                'size_bytes': self.total_bytes,
+                'files': len(self.entries)
+            }
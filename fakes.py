@@ -0,0 +1,928 @@
+"""In-memory stand-ins for the Firestore client, Storage bucket and Auth module.
+
+They implement the subset of each API that the app and its scripts use, so
+create_app can be pointed at them for benchmarks and local experiments
+without a Firebase project. Every call that would be a network round trip
+sleeps for `latency` seconds first (adjustable at any time) and is counted in
+`calls`; Firestore also counts documents returned in `documents_read`.
+
+Class names match the real client classes so that metrics.Instrumented
+recognises which calls are round trips.
+"""
+from firebase_admin import auth as firebase_auth
+from google.api_core import exceptions
+from google.cloud.firestore_v1 import DELETE_FIELD, SERVER_TIMESTAMP
+from google.cloud.firestore_v1.transforms import ArrayRemove, ArrayUnion, Increment
+from firebase_scripts import BATCH_WRITE_LIMIT
+from collections import Counter
+from datetime import datetime, timezone
+from operator import itemgetter
+from urllib.parse import quote
+import base64
+import copy
+import hashlib
+import heapq
+import io
+import itertools
+import threading
+import time
+import uuid
+
+DOCUMENT_ID = '__name__'
+# Firestore rejects write batches and transactions with more than BATCH_WRITE_LIMIT writes
+MAX_WRITES = BATCH_WRITE_LIMIT
+
+class FakeBackend:
+    """Latency injection and call counting shared by the three fakes."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()  # method name -> round trips
+        self.stats_lock = threading.Lock()
+
+    def _rpc(self, method, count=1):
+        with self.stats_lock:
+            self.calls[method] += count
+        if self.latency:
+            time.sleep(self.latency * count)
+
+    def total_calls(self):
+        with self.stats_lock:
+            return sum(self.calls.values())
+
+def now():
+    return datetime.now(timezone.utc)
+
+# Firestore
+
+def _stored(value):
+    """Return a copy of value as Firestore stores it: datetimes become timezone-aware UTC, naive ones taken as UTC."""
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+    if isinstance(value, dict):
+        return {key: _stored(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_stored(item) for item in value]
+    return value
+
+def _get_path(data, path):
+    for key in path.split('.'):
+        if not isinstance(data, dict) or key not in data:
+            raise KeyError(path)
+        data = data[key]
+    return data
+
+def _apply_value(current, value, timestamp):
+    if isinstance(value, ArrayUnion):
+        result = list(current) if isinstance(current, list) else []
+        result.extend(item for item in _stored(value.values) if item not in result)
+        return result
+    if isinstance(value, ArrayRemove):
+        removed = _stored(value.values)
+        return [item for item in current if item not in removed] if isinstance(current, list) else []
+    if isinstance(value, Increment):
+        return (current if isinstance(current, (int, float)) else 0) + value.value
+    if value is SERVER_TIMESTAMP:
+        return timestamp
+    return _stored(value)
+
+def _apply_field(data, path, value, timestamp):
+    keys = path.split('.')
+    for key in keys[:-1]:
+        if not isinstance(data.get(key), dict):
+            data[key] = {}
+        data = data[key]
+    if value is DELETE_FIELD:
+        data.pop(keys[-1], None)
+    else:
+        data[keys[-1]] = _apply_value(data.get(keys[-1]), value, timestamp)
+
+def _merge(data, updates, timestamp):
+    for key, value in updates.items():
+        if isinstance(value, dict) and isinstance(data.get(key), dict):
+            _merge(data[key], value, timestamp)
+        elif value is DELETE_FIELD:
+            data.pop(key, None)
+        elif isinstance(value, dict):
+            data[key] = {}
+            _merge(data[key], value, timestamp)
+        else:
+            data[key] = _apply_value(data.get(key), value, timestamp)
+
+def _hashable(value):
+    try:
+        hash(value)
+        return True
+    except TypeError:
+        return False
+
+class Client(FakeBackend):
+    """In-memory Firestore client.
+
+    Collections are indexed on demand for equality, 'in' and array_contains
+    filters, so queries stay fast at benchmark sizes. Transactions apply their
+    writes atomically but never conflict.
+    """
+
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self.lock = threading.RLock()
+        self.collections_data = {}  # collection path -> {document id -> (data, create_time, update_time)}
+        self.indexes = {}  # (collection path, field, 'eq' or 'contains') -> {value -> set of document ids}
+        self.documents_read = 0
+
+    def put(self, path, data):
+        """Store a document directly, without latency or call counting (for seeding)."""
+        collection_path, _, document_id = path.rpartition('/')
+        with self.lock:
+            self._write(collection_path, document_id, _stored(data), now())
+
+    def _count_documents(self, count):
+        with self.stats_lock:
+            self.documents_read += count
+
+    def collection(self, path):
+        return CollectionReference(self, path)
+
+    def document(self, path):
+        collection_path, _, document_id = path.rpartition('/')
+        return DocumentReference(self, collection_path, document_id)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def transaction(self, max_attempts=5, read_only=False):
+        return Transaction(self, max_attempts, read_only)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        self._rpc('get_all')
+        with self.lock:
+            snapshots = [self._snapshot(ref, field_paths) for ref in references]
+        self._count_documents(len(snapshots))
+        yield from snapshots
+
+    def collections(self):
+        self._rpc('collections')
+        with self.lock:
+            paths = [path for path in self.collections_data if '/' not in path]
+        return [CollectionReference(self, path) for path in paths]
+
+    def _snapshot(self, ref, field_paths=None):
+        entry = self.collections_data.get(ref.collection_path, {}).get(ref.id)
+        if entry is None:
+            return DocumentSnapshot(ref, None, None, None)
+        data, create_time, update_time = entry
+        return DocumentSnapshot(ref, _project(data, field_paths), create_time, update_time)
+
+    # Index maintenance; callers hold self.lock
+
+    def _index(self, collection_path, field, kind):
+        key = (collection_path, field, kind)
+        index = self.indexes.get(key)
+        if index is None:
+            index = self.indexes[key] = {}
+            for document_id, (data, _, _) in self.collections_data.get(collection_path, {}).items():
+                self._index_document(index, kind, data.get(field), document_id)
+        return index
+
+    @staticmethod
+    def _index_document(index, kind, value, document_id, remove=False):
+        values = value if kind == 'contains' and isinstance(value, list) else [value] if kind == 'eq' else []
+        for item in values:
+            if not _hashable(item):
+                continue
+            if remove:
+                ids = index.get(item)
+                if ids is not None:
+                    ids.discard(document_id)
+            else:
+                index.setdefault(item, set()).add(document_id)
+
+    def _write(self, collection_path, document_id, data, timestamp):
+        documents = self.collections_data.setdefault(collection_path, {})
+        old = documents.get(document_id)
+        for (path, field, kind), index in self.indexes.items():
+            if path == collection_path:
+                if old is not None:
+                    self._index_document(index, kind, old[0].get(field), document_id, remove=True)
+                if data is not None:
+                    self._index_document(index, kind, data.get(field), document_id)
+        if data is None:
+            documents.pop(document_id, None)
+        else:
+            documents[document_id] = (data, old[1] if old else timestamp, timestamp)
+
+    def _apply(self, writes):
+        """Validate and apply a list of (op, ref, data, merge) writes atomically."""
+        with self.lock:
+            timestamp = now()
+            staged = {}
+            for op, ref, data, merge in writes:
+                key = (ref.collection_path, ref.id)
+                if key in staged:
+                    current = staged[key]
+                else:
+                    entry = self.collections_data.get(ref.collection_path, {}).get(ref.id)
+                    current = copy.deepcopy(entry[0]) if entry else None
+
+                if op == 'create' and current is not None:
+                    raise exceptions.AlreadyExists(f'Document already exists: {ref.path}')
+                if op == 'update' and current is None:
+                    raise exceptions.NotFound(f'No document to update: {ref.path}')
+
+                if op == 'delete':
+                    current = None
+                elif op == 'update':
+                    for path, value in data.items():
+                        _apply_field(current, path, value, timestamp)
+                else:
+                    if current is None or not merge:
+                        current = {}
+                    _merge(current, data, timestamp)
+                staged[key] = current
+
+            for (collection_path, document_id), data in staged.items():
+                self._write(collection_path, document_id, data, timestamp)
+            return [WriteResult(timestamp) for _ in writes]
+
+class WriteResult:
+    def __init__(self, update_time):
+        self.update_time = update_time
+
+def _project(data, field_paths):
+    if field_paths is None:
+        return copy.deepcopy(data)
+    projected = {}
+    for path in field_paths:
+        try:
+            value = _get_path(data, path)
+        except KeyError:
+            continue
+        _apply_field(projected, path, value, None)
+    return projected
+
+class DocumentSnapshot:
+    def __init__(self, reference, data, create_time, update_time):
+        self.reference = reference
+        self._data = data
+        self.create_time = create_time
+        self.update_time = update_time
+
+    @property
+    def id(self):
+        return self.reference.id
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        if self._data is None:
+            return None
+        return copy.deepcopy(_get_path(self._data, field_path))
+
+class DocumentReference:
+    def __init__(self, client, collection_path, document_id):
+        self._client = client
+        self.collection_path = collection_path
+        self.id = document_id
+
+    @property
+    def path(self):
+        return f'{self.collection_path}/{self.id}'
+
+    @property
+    def parent(self):
+        return CollectionReference(self._client, self.collection_path)
+
+    def collection(self, name):
+        return CollectionReference(self._client, f'{self.path}/{name}')
+
+    def __eq__(self, other):
+        return isinstance(other, DocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def get(self, field_paths=None, transaction=None):
+        self._client._rpc('get')
+        with self._client.lock:
+            snapshot = self._client._snapshot(self, field_paths)
+        self._client._count_documents(1)
+        return snapshot
+
+    def create(self, document_data):
+        self._client._rpc('create')
+        return self._client._apply([('create', self, document_data, False)])[0]
+
+    def set(self, document_data, merge=False):
+        self._client._rpc('set')
+        return self._client._apply([('set', self, document_data, merge)])[0]
+
+    def update(self, field_updates):
+        self._client._rpc('update')
+        return self._client._apply([('update', self, field_updates, False)])[0]
+
+    def delete(self):
+        self._client._rpc('delete')
+        self._client._apply([('delete', self, None, False)])
+        return now()
+
+_OPERATORS = {
+    '==': lambda value, operand: value == operand,
+    '!=': lambda value, operand: value != operand,
+    '<': lambda value, operand: value < operand,
+    '<=': lambda value, operand: value <= operand,
+    '>': lambda value, operand: value > operand,
+    '>=': lambda value, operand: value >= operand,
+    'in': lambda value, operand: value in operand,
+    'not-in': lambda value, operand: value not in operand,
+    'array_contains': lambda value, operand: isinstance(value, list) and operand in value,
+    'array_contains_any': lambda value, operand: isinstance(value, list) and any(item in value for item in operand),
+}
+
+def _field_value(document_id, data, field):
+    if field == DOCUMENT_ID:
+        return document_id
+    return _get_path(data, field)
+
+class Query:
+    """An immutable query over one collection, built up the same way as a Firestore query."""
+
+    def __init__(self, client, collection_path, filters=(), orders=(), cursor=None, limit_count=None, fields=None):
+        self._client = client
+        self.collection_path = collection_path
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._cursor = cursor
+        self._limit = limit_count
+        self._fields = fields
+
+    def _copy(self, **changes):
+        state = {'filters': self._filters, 'orders': self._orders, 'cursor': self._cursor,
+                 'limit_count': self._limit, 'fields': self._fields}
+        state.update(changes)
+        return Query(self._client, self.collection_path, **state)
+
+    def where(self, field_path=None, op_string=None, value=None, *, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        if op_string not in _OPERATORS:
+            raise ValueError(f'Unsupported operator: {op_string}')
+        return self._copy(filters=self._filters + ((field_path, op_string, _stored(value)),))
+
+    def order_by(self, field_path, direction='ASCENDING'):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count):
+        return self._copy(limit_count=count)
+
+    def select(self, field_paths):
+        return self._copy(fields=list(field_paths))
+
+    def start_after(self, document_fields):
+        if isinstance(document_fields, DocumentSnapshot):
+            snapshot = document_fields
+            document_fields = {field: snapshot.id if field == DOCUMENT_ID else snapshot.get(field)
+                               for field, _ in self._orders}
+        return self._copy(cursor=_stored(dict(document_fields)))
+
+    def _candidates(self):
+        """Return (document IDs to scan, position of the filter an index already satisfied, or None)."""
+        for position, (field, op, value) in enumerate(self._filters):
+            if field == DOCUMENT_ID or '.' in field:
+                continue
+            if op == '==' and _hashable(value):
+                return self._client._index(self.collection_path, field, 'eq').get(value, ()), position
+            if op == 'in' and all(_hashable(item) for item in value):
+                index = self._client._index(self.collection_path, field, 'eq')
+                return set().union(*(index.get(item, ()) for item in value)), position
+            if op == 'array_contains' and _hashable(value):
+                return self._client._index(self.collection_path, field, 'contains').get(value, ()), position
+        return self._client.collections_data.get(self.collection_path, {}).keys(), None
+
+    @staticmethod
+    def _matches(document_id, data, filters):
+        for field, op, operand in filters:
+            try:
+                if not _OPERATORS[op](_field_value(document_id, data, field), operand):
+                    return False
+            except (KeyError, TypeError):
+                return False
+        return True
+
+    def _after_cursor(self, key, orders):
+        for value, (field, direction) in zip(key, orders):
+            cursor_value = self._cursor.get(field)
+            if value == cursor_value:
+                continue
+            return value > cursor_value if direction == 'ASCENDING' else value < cursor_value
+        return False
+
+    def _sorted(self, rows, orders):
+        directions = {direction for _, direction in orders}
+        if len(directions) == 1:
+            descending = directions == {'DESCENDING'}
+            if self._limit is not None:
+                select = heapq.nlargest if descending else heapq.nsmallest
+                return select(self._limit, rows, key=itemgetter(0))
+            return sorted(rows, key=itemgetter(0), reverse=descending)
+
+        for position in reversed(range(len(orders))):
+            rows.sort(key=lambda row: row[0][position], reverse=orders[position][1] == 'DESCENDING')
+        return rows if self._limit is None else rows[:self._limit]
+
+    def _run(self):
+        orders = self._orders or ((DOCUMENT_ID, 'ASCENDING'),)
+        with self._client.lock:
+            documents = self._client.collections_data.get(self.collection_path, {})
+            candidates, indexed = self._candidates()
+            filters = [f for position, f in enumerate(self._filters) if position != indexed]
+
+            rows = []  # (ordering key, document ID, stored entry)
+            for document_id in list(candidates):
+                entry = documents.get(document_id)
+                if entry is None or not self._matches(document_id, entry[0], filters):
+                    continue
+                try:
+                    key = tuple(_field_value(document_id, entry[0], field) for field, _ in orders)
+                except KeyError:
+                    continue  # Like Firestore, documents missing an ordering field are left out
+                if self._cursor is None or self._after_cursor(key, orders):
+                    rows.append((key, document_id, entry))
+
+            return [DocumentSnapshot(DocumentReference(self._client, self.collection_path, document_id),
+                                     _project(data, self._fields), create_time, update_time)
+                    for _, document_id, (data, create_time, update_time) in self._sorted(rows, orders)]
+
+    def stream(self, transaction=None):
+        self._client._rpc('stream')
+        snapshots = self._run()
+        self._client._count_documents(len(snapshots))
+        yield from snapshots
+
+    def get(self, transaction=None):
+        return list(self.stream(transaction))
+
+class CollectionReference(Query):
+    def __init__(self, client, path):
+        super().__init__(client, path)
+
+    @property
+    def id(self):
+        return self.collection_path.rpartition('/')[2]
+
+    def document(self, document_id=None):
+        return DocumentReference(self._client, self.collection_path, document_id or uuid.uuid4().hex[:20])
+
+    def add(self, document_data, document_id=None):
+        ref = self.document(document_id)
+        return ref.create(document_data), ref
+
+    def list_documents(self):
+        self._client._rpc('list_documents')
+        with self._client.lock:
+            ids = list(self._client.collections_data.get(self.collection_path, {}))
+        return [DocumentReference(self._client, self.collection_path, document_id) for document_id in ids]
+
+class WriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def _add(self, op, ref, data=None, merge=False):
+        self._writes.append((op, ref, data, merge))
+
+    def create(self, reference, document_data):
+        self._add('create', reference, document_data)
+
+    def set(self, reference, document_data, merge=False):
+        self._add('set', reference, document_data, merge)
+
+    def update(self, reference, field_updates):
+        self._add('update', reference, field_updates)
+
+    def delete(self, reference):
+        self._add('delete', reference)
+
+    def commit(self):
+        if len(self._writes) > MAX_WRITES:
+            raise exceptions.InvalidArgument(f'A write batch can contain at most {MAX_WRITES} writes.')
+        self._client._rpc('commit')
+        results = self._client._apply(self._writes)
+        self._writes = []
+        return results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+class Transaction(WriteBatch):
+    """Buffers writes and applies them on commit; works with firestore.transactional."""
+
+    _transaction_ids = itertools.count(1)
+
+    def __init__(self, client, max_attempts=5, read_only=False):
+        super().__init__(client)
+        self._max_attempts = max_attempts
+        self._read_only = read_only
+        self._id = None
+
+    @property
+    def in_progress(self):
+        return self._id is not None
+
+    def _begin(self, retry_id=None):
+        self._client._rpc('begin_transaction')
+        self._id = next(self._transaction_ids)
+
+    def _clean_up(self):
+        self._writes = []
+        self._id = None
+
+    def _rollback(self):
+        if self._id is not None:
+            self._client._rpc('rollback')
+        self._clean_up()
+
+    def _commit(self):
+        try:
+            return self.commit()
+        finally:
+            self._clean_up()
+
+    def get_all(self, references, field_paths=None):
+        return self._client.get_all(references, field_paths, transaction=self)
+
+    def get(self, ref_or_query):
+        if isinstance(ref_or_query, DocumentReference):
+            return self._client.get_all([ref_or_query], transaction=self)
+        return ref_or_query.stream(transaction=self)
+
+# Storage
+
+class StoredObject:
+    def __init__(self, data, content_type, generation):
+        self.data = data
+        self.content_type = content_type
+        self.generation = generation
+        self.updated = now()
+        self._md5_hash = None
+
+    @property
+    def md5_hash(self):
+        # Computed on first use so seeding many large objects stays cheap
+        if self._md5_hash is None:
+            self._md5_hash = base64.b64encode(hashlib.md5(self.data).digest()).decode()
+        return self._md5_hash
+
+class Bucket(FakeBackend):
+    """In-memory Storage bucket. Blob contents are kept as bytes; many blobs may share one object."""
+
+    def __init__(self, name='fake-bucket', latency=0.0):
+        super().__init__(latency)
+        self.name = name
+        self.lock = threading.Lock()
+        self.objects = {}  # blob name -> StoredObject
+        self.generations = itertools.count(int(time.time() * 1e6))
+        self.bytes_sent = 0
+
+    def blob(self, blob_name, chunk_size=None):
+        return Blob(self, blob_name, chunk_size)
+
+    def get_blob(self, blob_name):
+        self._rpc('get_blob')
+        blob = Blob(self, blob_name)
+        return blob if blob._load() else None
+
+    def list_blobs(self, prefix=None):
+        self._rpc('list_blobs')
+        with self.lock:
+            names = sorted(name for name in self.objects if prefix is None or name.startswith(prefix))
+        blobs = [Blob(self, name) for name in names]
+        for blob in blobs:
+            blob._load()
+        return iter(blobs)
+
+    def delete_blob(self, blob_name):
+        self.blob(blob_name).delete()
+
+    def _store(self, blob_name, data, content_type, if_generation_match=None):
+        with self.lock:
+            if if_generation_match is not None:
+                # Generation 0 means the object must not exist yet
+                current = self.objects.get(blob_name)
+                if (current.generation if current else 0) != if_generation_match:
+                    raise exceptions.PreconditionFailed(f'Generation mismatch: {self.name}/{blob_name}')
+            stored = StoredObject(bytes(data), content_type, next(self.generations))
+            self.objects[blob_name] = stored
+            return stored
+
+    def put(self, blob_name, data, content_type='application/pdf'):
+        """Store an object directly, without latency or call counting (for seeding)."""
+        return self._store(blob_name, data, content_type)
+
+    def _read(self, blob_name, start=0, end=None):
+        with self.lock:
+            stored = self.objects.get(blob_name)
+        if stored is None:
+            raise exceptions.NotFound(f'No such object: {self.name}/{blob_name}')
+        data = stored.data[start:end]
+        with self.stats_lock:
+            self.bytes_sent += len(data)
+        return data
+
+class Blob:
+    def __init__(self, bucket, name, chunk_size=None):
+        self.bucket = bucket
+        self.name = name
+        self.chunk_size = chunk_size
+        self.size = None
+        self.generation = None
+        self.md5_hash = None
+        self.updated = None
+        self.content_type = None
+
+    @property
+    def public_url(self):
+        return f'https://storage.googleapis.com/{self.bucket.name}/{quote(self.name)}'
+
+    @property
+    def etag(self):
+        return self.md5_hash
+
+    def _load(self):
+        with self.bucket.lock:
+            stored = self.bucket.objects.get(self.name)
+        if stored is None:
+            return False
+        self._set_metadata(stored)
+        return True
+
+    def _set_metadata(self, stored):
+        self.size = len(stored.data)
+        self.generation = stored.generation
+        self.md5_hash = stored.md5_hash
+        self.updated = stored.updated
+        self.content_type = stored.content_type
+
+    def reload(self):
+        self.bucket._rpc('reload')
+        if not self._load():
+            raise exceptions.NotFound(f'No such object: {self.bucket.name}/{self.name}')
+
+    def exists(self):
+        self.bucket._rpc('exists')
+        with self.bucket.lock:
+            return self.name in self.bucket.objects
+
+    def _upload_calls(self, size):
+        # Resumable uploads send one request per chunk
+        if self.chunk_size:
+            return max(1, -(-size // self.chunk_size))
+        return 1
+
+    def upload_from_string(self, data, content_type='text/plain', if_generation_match=None):
+        if isinstance(data, str):
+            data = data.encode()
+        self.bucket._rpc('upload', self._upload_calls(len(data)))
+        self._set_metadata(self.bucket._store(self.name, data, content_type, if_generation_match))
+
+    def upload_from_file(self, file_obj, content_type=None, if_generation_match=None):
+        self.upload_from_string(file_obj.read(), content_type or 'application/octet-stream', if_generation_match)
+
+    def upload_from_filename(self, filename, content_type=None, if_generation_match=None):
+        with open(filename, 'rb') as f:
+            self.upload_from_file(f, content_type, if_generation_match)
+
+    def download_as_bytes(self, start=None, end=None):
+        # Like the real client, end is inclusive
+        self.bucket._rpc('download')
+        return self.bucket._read(self.name, start or 0, None if end is None else end + 1)
+
+    def download_to_file(self, file_obj):
+        self.bucket._rpc('download')
+        file_obj.write(self.bucket._read(self.name))
+
+    def download_to_filename(self, filename):
+        with open(filename, 'wb') as f:
+            self.download_to_file(f)
+
+    def open(self, mode='rb', chunk_size=None):
+        if mode != 'rb':
+            raise ValueError('Only binary reads are supported.')
+        # Opening is local; like the real reader, metadata is only fetched if it is not loaded yet
+        if self.size is None:
+            self.reload()
+        return BlobReader(self, chunk_size or self.chunk_size or 40 * 1024 * 1024)
+
+    def make_public(self):
+        self.bucket._rpc('make_public')
+
+    def delete(self):
+        self.bucket._rpc('delete')
+        with self.bucket.lock:
+            if self.bucket.objects.pop(self.name, None) is None:
+                raise exceptions.NotFound(f'No such object: {self.bucket.name}/{self.name}')
+
+    def generate_signed_url(self, expiration=None, method='GET', version='v4', **kwargs):
+        # Signing happens locally in the real client, so this is not a round trip
+        if isinstance(expiration, (int, float)):
+            expires = int(expiration)
+        else:
+            expires = int((now() + expiration).timestamp()) if expiration is not None else 3600
+        return f'{self.public_url}?X-Fake-Method={method}&X-Fake-Expires={expires}&X-Fake-Signature={uuid.uuid4().hex}'
+
+class BlobReader(io.RawIOBase):
+    """Reads a blob in chunk_size pieces, one round trip per piece, like storage.fileio.BlobReader."""
+
+    def __init__(self, blob, chunk_size):
+        super().__init__()
+        self.blob = blob
+        self.chunk_size = chunk_size
+        self.position = 0
+        self.buffer = b''
+        self.buffer_start = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.blob.size - self.position
+        result = []
+        while size > 0 and self.position < self.blob.size:
+            offset = self.position - self.buffer_start
+            if not 0 <= offset < len(self.buffer):
+                self.blob.bucket._rpc('download')
+                self.buffer = self.blob.bucket._read(self.blob.name, self.position, self.position + self.chunk_size)
+                self.buffer_start, offset = self.position, 0
+                if not self.buffer:
+                    break
+            piece = self.buffer[offset:offset + size]
+            result.append(piece)
+            self.position += len(piece)
+            size -= len(piece)
+        return b''.join(result)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.blob.size
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+# Auth
+
+class UserRecord:
+    def __init__(self, uid, email, password=None, custom_claims=None, disabled=False):
+        self.uid = uid
+        self.email = email
+        self.password = password
+        self.custom_claims = custom_claims
+        self.disabled = disabled
+
+class ImportResult:
+    def __init__(self, total, errors):
+        self.errors = errors
+        self.failure_count = len(errors)
+        self.success_count = total - len(errors)
+
+class ImportUserError:
+    def __init__(self, index, reason):
+        self.index = index
+        self.reason = reason
+
+class FakeAuth(FakeBackend):
+    """In-memory replacement for the firebase_admin.auth module."""
+
+    # Value types and errors the app takes from the auth module
+    ImportUserRecord = firebase_auth.ImportUserRecord
+    UserImportHash = firebase_auth.UserImportHash
+    UserNotFoundError = firebase_auth.UserNotFoundError
+    EmailAlreadyExistsError = firebase_auth.EmailAlreadyExistsError
+
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self.lock = threading.Lock()
+        self.users = {}  # uid -> UserRecord
+        self.uids_by_email = {}
+
+    def add_user(self, uid, email, password=None, custom_claims=None):
+        """Create a user directly, without latency or call counting (for seeding)."""
+        with self.lock:
+            self.users[uid] = UserRecord(uid, email, password, custom_claims)
+            self.uids_by_email[email] = uid
+        return self.users[uid]
+
+    def _user(self, uid):
+        user = self.users.get(uid)
+        if user is None:
+            raise firebase_auth.UserNotFoundError(f'No user record found for the provided user ID: {uid}.')
+        return user
+
+    def get_user(self, uid):
+        self._rpc('get_user')
+        with self.lock:
+            return self._user(uid)
+
+    def get_user_by_email(self, email):
+        self._rpc('get_user_by_email')
+        with self.lock:
+            uid = self.uids_by_email.get(email)
+            if uid is None:
+                raise firebase_auth.UserNotFoundError(f'No user record found for the provided email: {email}.')
+            return self.users[uid]
+
+    def create_user(self, uid=None, email=None, password=None, **kwargs):
+        self._rpc('create_user')
+        with self.lock:
+            if email in self.uids_by_email:
+                raise firebase_auth.EmailAlreadyExistsError(
+                    'The user with the provided email already exists.', None, None)
+            uid = uid or uuid.uuid4().hex[:28]
+            self.users[uid] = UserRecord(uid, email, password, kwargs.get('custom_claims'))
+            if email:
+                self.uids_by_email[email] = uid
+            return self.users[uid]
+
+    def update_user(self, uid, **kwargs):
+        self._rpc('update_user')
+        with self.lock:
+            user = self._user(uid)
+            if 'email' in kwargs and kwargs['email'] != user.email:
+                if kwargs['email'] in self.uids_by_email:
+                    raise firebase_auth.EmailAlreadyExistsError(
+                        'The user with the provided email already exists.', None, None)
+                self.uids_by_email.pop(user.email, None)
+                user.email = kwargs['email']
+                self.uids_by_email[user.email] = uid
+            for field in ('password', 'custom_claims', 'disabled'):
+                if field in kwargs:
+                    setattr(user, field, kwargs[field])
+            return user
+
+    def set_custom_user_claims(self, uid, custom_claims):
+        self.update_user(uid, custom_claims=custom_claims)
+
+    def delete_user(self, uid):
+        self._rpc('delete_user')
+        with self.lock:
+            user = self._user(uid)
+            del self.users[uid]
+            self.uids_by_email.pop(user.email, None)
+
+    def import_users(self, users, hash_alg=None):
+        # Like the real API: an existing uid is overwritten and emails are not checked for
+        # uniqueness, so importing a taken email creates a second account with it
+        self._rpc('import_users')
+        with self.lock:
+            for record in users:
+                previous = self.users.get(record.uid)
+                if previous is not None and self.uids_by_email.get(previous.email) == record.uid:
+                    del self.uids_by_email[previous.email]
+                self.users[record.uid] = UserRecord(record.uid, record.email, custom_claims=record.custom_claims)
+                if record.email:
+                    self.uids_by_email.setdefault(record.email, record.uid)
+        return ImportResult(len(users), [])
+
+    def get_users(self, identifiers):
+        self._rpc('get_users')
+        if len(identifiers) > 100:
+            raise ValueError('`identifiers` parameter must have <= 100 entries.')
+        found, not_found = [], []
+        with self.lock:
+            for identifier in identifiers:
+                if isinstance(identifier, firebase_auth.EmailIdentifier):
+                    uids = [uid for uid, user in self.users.items() if user.email == identifier.email]
+                else:
+                    uids = [identifier.uid] if identifier.uid in self.users else []
+                found.extend(self.users[uid] for uid in uids)
+                if not uids:
+                    not_found.append(identifier)
+        return firebase_auth.GetUsersResult(found, not_found)
+
+    def delete_users(self, uids):
+        self._rpc('delete_users')
+        if len(uids) > 1000:
+            raise ValueError('`uids` parameter must have <= 1000 entries.')
+        with self.lock:
+            for uid in uids:
+                user = self.users.pop(uid, None)
+                if user is not None and self.uids_by_email.get(user.email) == uid:
+                    del self.uids_by_email[user.email]
+        # Like the real API, users that did not exist count as deleted
+        return ImportResult(len(uids), [])
@@ -0,0 +1,27 @@
+import firebase_admin
+from firebase_admin import credentials, firestore, storage
+import json
+import os
+
+# Firestore rejects write batches and transactions with more than 500 writes
+BATCH_WRITE_LIMIT = 500
+
+def initialize_firebase(cred_path, bucket_name=None):
+    """Initialize Firebase Admin SDK and return the Storage bucket (None without bucket_name) and Firestore client."""
+    cred = credentials.Certificate(cred_path)
+    firebase_admin.initialize_app(cred, {'storageBucket': bucket_name} if bucket_name else None)
+    return (storage.bucket() if bucket_name else None), firestore.client()
+
+def load_checkpoint(checkpoint_path, default):
+    """Load a script's checkpoint, or return default if it has not saved one yet."""
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            return json.load(f)
+    return default
+
+def save_checkpoint(checkpoint_path, checkpoint):
+    """Write the checkpoint atomically so a crash never leaves a partial file."""
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, checkpoint_path)
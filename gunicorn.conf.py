@@ -0,0 +1,14 @@
+# Gunicorn settings. Each worker creates its own Firebase clients on first
+# use; the post_worker_init hook below makes that happen (and opens the
+# connections) before the worker accepts its first request.
+import logging
+import os
+
+wsgi_app = 'app:create_app()'
+
+# Workers are forked from the master, so they inherit this logging setup
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
+
+def post_worker_init(worker):
+    from app import warm_up
+    warm_up(worker.wsgi)
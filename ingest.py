@@ -0,0 +1,194 @@
+from firebase_admin import auth
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from firebase_scripts import BATCH_WRITE_LIMIT, initialize_firebase
+from uploads import UploadClaims, upload_pdf, record_pdfs
+import argparse
+import csv
+import datetime
+import json
+import os
+import threading
+import time
+
+# Each file needs up to three writes (its 'pdfs' document, its hash index
+# entry and its patient's summary)
+WRITES_PER_FILE = 3
+UPLOAD_WORKERS = 8
+
+def scan_directory(root):
+    """Find PDFs laid out as <root>/<patient UID or email>/[<subdirectories>/]<file>.pdf.
+
+    Files with the same name in different subdirectories do not collide:
+    each is stored under its content hash. Returns a list of (file_path,
+    patient) pairs.
+    """
+    jobs = []
+    for patient in sorted(os.listdir(root)):
+        patient_dir = os.path.join(root, patient)
+        if not os.path.isdir(patient_dir):
+            continue
+        for dirpath, _, filenames in os.walk(patient_dir):
+            for filename in sorted(filenames):
+                if filename.lower().endswith('.pdf'):
+                    jobs.append((os.path.join(dirpath, filename), patient))
+    return jobs
+
+def read_manifest(manifest_path):
+    """Read a CSV manifest with 'file' and 'patient' (UID or email) columns.
+
+    Relative file paths are resolved against the manifest's directory.
+    Returns a list of (file_path, patient) pairs.
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, newline='', encoding='utf-8-sig') as f:
+        return [(os.path.join(base_dir, row['file'].strip()), row['patient'].strip())
+                for row in csv.DictReader(f)]
+
+def resolve_patients(patients):
+    """Map each patient key to a UID, looking up keys that look like emails in Firebase Auth."""
+    uids = {}
+    for patient in set(patients):
+        if '@' not in patient:
+            uids[patient] = patient
+            continue
+        try:
+            uids[patient] = auth.get_user_by_email(patient).uid
+        except Exception as e:
+            print(f"Skipping files for {patient}: {e}")
+    return uids
+
+class Progress:
+    """Append-only JSON-lines log of ingestion progress, used to resume a crashed run.
+
+    Each file is logged once when its upload finishes (with the 'pdfs'
+    document ID and metadata to write) and once more when that metadata has
+    been committed. On restart, committed files are skipped and uploaded ones
+    only have their metadata written.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries[entry['file']] = entry
+
+    def status(self, file_path):
+        entry = self.entries.get(file_path)
+        return entry['status'] if entry else None
+
+    def record(self, entry):
+        with self.lock:
+            self.entries[entry['file']] = entry
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry, default=lambda value: value.isoformat()) + '\n')
+
+class MetadataWriter:
+    """Buffer PDF metadata and commit it in transactions of at most BATCH_WRITE_LIMIT writes."""
+
+    def __init__(self, db, progress):
+        self.db = db
+        self.progress = progress
+        self.pending = []
+
+    def add(self, entry):
+        # Commit first if this entry's writes would take the transaction over the limit
+        if (len(self.pending) + 1) * WRITES_PER_FILE > BATCH_WRITE_LIMIT:
+            self.flush()
+        self.pending.append(entry)
+
+    def flush(self):
+        if not self.pending:
+            return
+        # Document IDs are chosen at upload time, so re-committing after a crash is idempotent
+        record_pdfs(self.db.transaction(), self.db, [(entry['pdf_id'], entry['pdf_data']) for entry in self.pending])
+        for entry in self.pending:
+            self.progress.record(dict(entry, status='committed'))
+        self.pending = []
+
+def upload_job(bucket, db, progress, claims, file_path, uid):
+    """Upload one file and log it. Returns (upload status, progress entry, bytes sent).
+
+    Duplicates of a report the patient already has are logged as done without
+    a metadata entry; content already stored for another patient, earlier in
+    this run or before it, is linked without re-sending any bytes.
+    """
+    status, pdf_data = upload_pdf(bucket, db, uid, file_path, claims)
+    if status == 'duplicate':
+        progress.record({'file': file_path, 'status': 'committed'})
+        return status, None, 0
+
+    entry = {
+        'file': file_path,
+        'status': 'uploaded',
+        'pdf_id': db.collection('pdfs').document().id,
+        'pdf_data': pdf_data
+    }
+    progress.record(entry)
+    return status, entry, os.path.getsize(file_path) if status == 'uploaded' else 0
+
+def ingest(bucket, db, jobs, progress, workers=UPLOAD_WORKERS):
+    """Upload (file_path, patient) jobs with a bounded thread pool and batch their metadata writes."""
+    uids = resolve_patients(patient for _, patient in jobs)
+    writer = MetadataWriter(db, progress)
+    claims = UploadClaims()
+    files_done = bytes_done = failed = skipped = duplicates = linked = 0
+    started = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for file_path, patient in jobs:
+            status = progress.status(file_path)
+            if status == 'committed' or patient not in uids:
+                skipped += 1
+            elif status == 'uploaded':
+                # Uploaded before a crash; only the metadata still needs writing
+                entry = dict(progress.entries[file_path])
+                entry['pdf_data'] = dict(entry['pdf_data'],
+                                         upload_date=datetime.datetime.fromisoformat(entry['pdf_data']['upload_date']))
+                pdf_data = entry['pdf_data']
+                claims.add(pdf_data['sha256'], pdf_data['patient_id'], pdf_data['pdf_file'], pdf_data['pdf_url'])
+                writer.add(entry)
+            else:
+                futures[pool.submit(upload_job, bucket, db, progress, claims, file_path, uids[patient])] = file_path
+
+        for future in as_completed(futures):
+            try:
+                status, entry, size = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"Failed to upload {futures[future]}: {e}")
+                continue
+            if status == 'duplicate':
+                duplicates += 1
+                continue
+            linked += status == 'linked'
+            files_done += status == 'uploaded'
+            bytes_done += size
+            writer.add(entry)
+
+    writer.flush()
+
+    elapsed = max(time.monotonic() - started, 1e-9)
+    print(f"Uploaded {files_done} files ({bytes_done / 1e6:.1f} MB) in {elapsed:.1f}s: "
+          f"{files_done / elapsed:.2f} files/sec, {bytes_done / 1e6 / elapsed:.2f} MB/sec "
+          f"({linked} linked, {duplicates} duplicates, {skipped} skipped, {failed} failed)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Upload patient PDF reports to Firebase Storage.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--dir', help="Directory laid out as <patient UID or email>/[<subdirectories>/]<file>.pdf")
+    source.add_argument('--manifest', help="CSV manifest with 'file' and 'patient' columns")
+    parser.add_argument('--credentials', required=True, help="Path to the service account key file")
+    parser.add_argument('--bucket', required=True, help="Firebase Storage bucket name")
+    parser.add_argument('--progress', default='ingest.progress.jsonl', help="File used to resume an interrupted run")
+    parser.add_argument('--workers', type=int, default=UPLOAD_WORKERS)
+    args = parser.parse_args()
+
+    bucket, db = initialize_firebase(args.credentials, args.bucket)
+    jobs = scan_directory(args.dir) if args.dir else read_manifest(args.manifest)
+    ingest(bucket, db, jobs, Progress(args.progress), args.workers)
@@ -0,0 +1,242 @@
+from contextlib import contextmanager
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    run_at REAL NOT NULL,
+    lease_until REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, run_at);
+CREATE INDEX IF NOT EXISTS jobs_created ON jobs (created_at);
+"""
+
+# Failed attempts are retried after RETRY_BASE_DELAY, doubling up to RETRY_MAX_DELAY
+MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 2.0
+RETRY_MAX_DELAY = 300.0
+# A running job's lease is renewed every LEASE_SECONDS / 3 while its worker is
+# alive; a job whose lease runs out (its process died) counts as a failed
+# attempt and is retried with the same backoff.
+LEASE_SECONDS = 60.0
+LEASE_EXPIRED_ERROR = 'Lease expired: the worker running the job stopped'
+POLL_INTERVAL = 1.0
+
+class JobQueue:
+    """Persistent queue of background jobs, stored in SQLite and run by a pool of worker threads.
+
+    Jobs are (kind, JSON payload) pairs run by the handler registered for
+    their kind, which returns a JSON-serialisable result. A job that raises is
+    retried with exponential backoff, up to MAX_ATTEMPTS attempts, and a job
+    whose process dies is retried the same way once its lease expires, so
+    handlers must be idempotent. Several processes may share the database
+    file; each job is claimed by one worker at a time. Workers start on first
+    use in each process, so a queue created before a server forks its
+    workers is safe.
+    """
+
+    def __init__(self, path, handlers, workers=2, context=None):
+        self.path = path
+        self.handlers = handlers
+        self.workers = workers
+        self.context = context  # Optional function returning a context manager each job runs in
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pid = None
+        self.running = set()  # IDs of the jobs this process is running
+        with self._connect() as conn:
+            # WAL lets the status view read while a worker is writing
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        # sqlite3 connections cannot be shared between threads, and opening one is cheap
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def start(self):
+        """Start this process's worker threads, if they are not running yet."""
+        with self.lock:
+            if self.pid == os.getpid() or self.workers <= 0:
+                return
+            # Threads do not survive a fork, so a forked child starts its own
+            self.pid = os.getpid()
+            self.running = set()
+            for i in range(self.workers):
+                threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True).start()
+            threading.Thread(target=self._renew_leases, name='job-leases', daemon=True).start()
+
+    def enqueue(self, kind, payload, key=None, max_attempts=MAX_ATTEMPTS):
+        """Queue a job and return its ID.
+
+        A job with a key is only queued once while it is pending: enqueueing
+        the same key again returns the queued or running job. A finished or
+        failed job with that key is queued again with the new payload.
+        """
+        if kind not in self.handlers:
+            raise ValueError(f'No handler for job kind {kind!r}')
+        job_id = key or uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT status FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is None:
+                conn.execute('INSERT INTO jobs (id, kind, payload, status, max_attempts, run_at, created_at, updated_at) '
+                             "VALUES (?, ?, ?, 'queued', ?, ?, ?, ?)",
+                             (job_id, kind, json.dumps(payload), max_attempts, now, now, now))
+            elif row['status'] in ('done', 'failed'):
+                conn.execute("UPDATE jobs SET kind = ?, payload = ?, status = 'queued', attempts = 0, max_attempts = ?, "
+                             'run_at = ?, lease_until = NULL, created_at = ?, updated_at = ?, result = NULL, error = NULL '
+                             'WHERE id = ?', (kind, json.dumps(payload), max_attempts, now, now, now, job_id))
+            conn.execute('COMMIT')
+        self.start()
+        self.wakeup.set()
+        return job_id
+
+    def get(self, job_id):
+        """Return a job as a dict, or None if there is no such job."""
+        with self._connect() as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._as_dict(row) if row is not None else None
+
+    def recent(self, limit=50):
+        """Return the most recently queued jobs, newest first."""
+        with self._connect() as conn:
+            rows = conn.execute('SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?', (limit,)).fetchall()
+        return [self._as_dict(row) for row in rows]
+
+    def stats(self):
+        """Return the number of jobs in each status."""
+        with self._connect() as conn:
+            rows = conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        return {status: count for status, count in rows}
+
+    def wait_idle(self, timeout=None):
+        """Block until no job is queued or running; returns False if timeout seconds pass first."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            stats = self.stats()
+            if not stats.get('queued') and not stats.get('running'):
+                return True
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+
+    def _as_dict(self, row):
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        job['result'] = json.loads(job['result']) if job['result'] is not None else None
+        return job
+
+    def _claim(self):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            self._expire_leases(conn, now)
+            row = conn.execute("SELECT * FROM jobs WHERE status = 'queued' AND run_at <= ? ORDER BY run_at LIMIT 1",
+                               (now,)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_until = ?, "
+                             'updated_at = ? WHERE id = ?', (now + LEASE_SECONDS, now, row['id']))
+            conn.execute('COMMIT')
+        if row is None:
+            return None
+        job = dict(row)
+        job['attempts'] += 1
+        return job
+
+    def _expire_leases(self, conn, now):
+        """Requeue or fail the running jobs whose lease has run out, as if their attempt had raised."""
+        expired = conn.execute("SELECT id, attempts, max_attempts FROM jobs WHERE status = 'running' AND lease_until < ?",
+                               (now,)).fetchall()
+        for row in expired:
+            self._set_failed_attempt(conn, row, LEASE_EXPIRED_ERROR, now)
+
+    def _set_failed_attempt(self, conn, job, error, now):
+        if job['attempts'] < job['max_attempts']:
+            delay = min(RETRY_BASE_DELAY * 2 ** (job['attempts'] - 1), RETRY_MAX_DELAY)
+            conn.execute("UPDATE jobs SET status = 'queued', run_at = ?, lease_until = NULL, updated_at = ?, "
+                         'error = ? WHERE id = ?', (now + delay, now, error, job['id']))
+        else:
+            conn.execute("UPDATE jobs SET status = 'failed', lease_until = NULL, updated_at = ?, error = ? "
+                         'WHERE id = ?', (now, error, job['id']))
+
+    def _work(self):
+        while True:
+            try:
+                job = self._claim()
+                if job is not None:
+                    self._run(job)
+                    continue
+            except Exception:
+                # The job, if one was claimed, is picked up again when its lease runs out
+                logger.exception("Error updating the job queue")
+            self.wakeup.wait(POLL_INTERVAL)
+            self.wakeup.clear()
+
+    def _run(self, job):
+        with self.lock:
+            self.running.add(job['id'])
+        try:
+            handler = self.handlers.get(job['kind'])
+            if handler is None:
+                raise ValueError(f'No handler for job kind {job["kind"]!r}')
+            payload = json.loads(job['payload'])
+            if self.context is not None:
+                with self.context():
+                    result = handler(payload)
+            else:
+                result = handler(payload)
+        except Exception as e:
+            logger.exception("Job %s (%s) failed on attempt %d", job['id'], job['kind'], job['attempts'])
+            self._finish(job, error=f'{type(e).__name__}: {e}')
+        else:
+            self._finish(job, result=result)
+        finally:
+            with self.lock:
+                self.running.discard(job['id'])
+
+    def _finish(self, job, result=None, error=None):
+        now = time.time()
+        with self._connect() as conn:
+            if error is None:
+                conn.execute("UPDATE jobs SET status = 'done', lease_until = NULL, updated_at = ?, result = ?, "
+                             'error = NULL WHERE id = ?', (now, json.dumps(result), job['id']))
+            else:
+                self._set_failed_attempt(conn, job, error, now)
+
+    def _renew_leases(self):
+        while True:
+            time.sleep(LEASE_SECONDS / 3)
+            with self.lock:
+                job_ids = list(self.running)
+            if not job_ids:
+                continue
+            try:
+                with self._connect() as conn:
+                    conn.executemany("UPDATE jobs SET lease_until = ? WHERE id = ? AND status = 'running'",
+                                     [(time.time() + LEASE_SECONDS, job_id) for job_id in job_ids])
+            except Exception:
+                logger.exception("Error renewing job leases")
@@ -0,0 +1,239 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import threading
+import time
+
+# Latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Methods that make a network round trip, by receiver class. Everything else
+# (building references, queries and batches) is local and only has its
+# result wrapped so that the eventual RPC is seen. firestore.transactional
+# begins, commits and rolls back through Transaction's private methods, so
+# those are listed too.
+RPC_METHODS = {
+    'Client': {'get_all', 'collections'},
+    'CollectionReference': {'add', 'get', 'stream', 'list_documents'},
+    'DocumentReference': {'get', 'set', 'update', 'delete', 'create', 'collections'},
+    'Query': {'get', 'stream'},
+    'AggregationQuery': {'get', 'stream'},
+    'WriteBatch': {'commit'},
+    'Transaction': {'get', 'get_all', '_begin', '_commit', '_rollback'},
+    'Bucket': {'get_blob', 'list_blobs', 'reload'},
+    'Blob': {'download_to_file', 'download_to_filename', 'download_as_bytes', 'upload_from_file',
+             'upload_from_filename', 'upload_from_string', 'make_public', 'reload', 'exists', 'delete', 'open'},
+    'BlobReader': {'read'},
+}
+# Every public function of the Auth module (or its fake) calls the Auth API
+ALL_CALLS_ARE_RPCS = {'auth'}
+
+class BackendStats:
+    """Thread-safe counters of backend calls, documents read, bytes transferred and time, per service."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.services = {}  # service -> [calls, documents, bytes, seconds]
+
+    def add(self, service, calls=0, documents=0, nbytes=0, seconds=0.0):
+        with self.lock:
+            counters = self.services.setdefault(service, [0, 0, 0, 0.0])
+            counters[0] += calls
+            counters[1] += documents
+            counters[2] += nbytes
+            counters[3] += seconds
+
+    def snapshot(self):
+        with self.lock:
+            return {service: list(counters) for service, counters in self.services.items()}
+
+# Stats for the request being handled in the current context. Thread pools
+# that work on behalf of a request should run their tasks in a copy of the
+# submitting context (contextvars.copy_context) so their calls are counted.
+current_request_stats = ContextVar('current_request_stats', default=None)
+background_stats = BackendStats()
+
+def record(service, calls=0, documents=0, nbytes=0, seconds=0.0):
+    stats = current_request_stats.get() or background_stats
+    stats.add(service, calls, documents, nbytes, seconds)
+
+@contextmanager
+def recording_to(stats):
+    """Count the backend calls made inside the block in stats, whatever context they run in."""
+    token = current_request_stats.set(stats)
+    try:
+        yield
+    finally:
+        current_request_stats.reset(token)
+
+def unwrap(value):
+    """Replace instrumented proxies in call arguments with the objects they wrap."""
+    if isinstance(value, Instrumented):
+        return value._target
+    if isinstance(value, list):
+        return [unwrap(item) for item in value]
+    if isinstance(value, tuple):
+        return tuple(unwrap(item) for item in value)
+    if isinstance(value, dict):
+        return {key: unwrap(item) for key, item in value.items()}
+    return value
+
+class Instrumented:
+    """Transparent proxy around a Firestore, Storage or Auth client that records every backend call.
+
+    Results that can lead to further calls (references, queries, batches,
+    blobs) are wrapped in turn; proxies passed back into the client are
+    unwrapped, so the client library only ever sees its own objects.
+    """
+
+    __slots__ = ('_target', '_service')
+
+    def __init__(self, target, service):
+        object.__setattr__(self, '_target', target)
+        object.__setattr__(self, '_service', service)
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if not callable(value) or isinstance(value, type):
+            return value
+        if name.startswith('_') and name not in RPC_METHODS.get(type(self._target).__name__, ()):
+            return value
+
+        def call(*args, **kwargs):
+            return self._call(name, value, unwrap(list(args)), unwrap(kwargs))
+        return call
+
+    def __setattr__(self, name, value):
+        setattr(self._target, name, unwrap(value))
+
+    def __enter__(self):
+        return self._wrap(self._target.__enter__())
+
+    def __exit__(self, *exc_info):
+        return self._target.__exit__(*exc_info)
+
+    def __repr__(self):
+        return f"Instrumented({self._target!r})"
+
+    def _wrap(self, value):
+        if type(value).__name__ in RPC_METHODS:
+            return Instrumented(value, self._service)
+        return value
+
+    def _call(self, name, method, args, kwargs):
+        target_type = type(self._target).__name__
+        if self._service not in ALL_CALLS_ARE_RPCS and name not in RPC_METHODS.get(target_type, ()):
+            return self._wrap(method(*args, **kwargs))
+
+        started = time.perf_counter()
+        try:
+            result = method(*args, **kwargs)
+        except Exception:
+            record(self._service, calls=1, seconds=time.perf_counter() - started)
+            raise
+        elapsed = time.perf_counter() - started
+
+        if (name in ('stream', 'get_all') or (name == 'get' and isinstance(result, list))
+                or (target_type == 'Transaction' and name == 'get')):
+            record(self._service, calls=1, seconds=elapsed)
+            return self._count_documents(iter(result))
+        if target_type == 'DocumentReference' and name == 'get':
+            record(self._service, calls=1, documents=1, seconds=elapsed)
+        elif name == 'read' or name == 'download_as_bytes':
+            record(self._service, calls=1, nbytes=len(result), seconds=elapsed)
+        elif name == 'download_to_file' or name == 'download_to_filename':
+            record(self._service, calls=1, nbytes=self._target.size or 0, seconds=elapsed)
+        else:
+            record(self._service, calls=1, seconds=elapsed)
+        return self._wrap(result)
+
+    def _count_documents(self, iterator):
+        # Streams fetch lazily, so time spent pulling each document counts as backend time
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                record(self._service, seconds=time.perf_counter() - started)
+                return
+            record(self._service, documents=1, seconds=time.perf_counter() - started)
+            yield item
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class MetricsRegistry:
+    """Process-wide per-endpoint latency histograms and backend usage counters."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}  # (endpoint, method, status) -> count
+        self.latency = {}  # endpoint -> [bucket counts..., sum, count]
+        self.backend = {}  # (endpoint, service) -> [calls, documents, bytes, seconds]
+
+    def observe_request(self, endpoint, method, status, seconds, stats):
+        with self.lock:
+            key = (endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+            histogram = self.latency.setdefault(endpoint, [0] * len(LATENCY_BUCKETS) + [0.0, 0])
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+            self._add_backend(endpoint, stats)
+
+    def observe_backend(self, endpoint, stats):
+        """Add backend usage to an endpoint's totals, e.g. for a body streamed after its request was observed."""
+        with self.lock:
+            self._add_backend(endpoint, stats)
+
+    def _add_backend(self, endpoint, stats):
+        for service, counters in stats.snapshot().items():
+            totals = self.backend.setdefault((endpoint, service), [0, 0, 0, 0.0])
+            for i, value in enumerate(counters):
+                totals[i] += value
+
+    def render(self):
+        """Render all metrics in the Prometheus text exposition format."""
+        with self.lock:
+            backend = {key: list(value) for key, value in self.backend.items()}
+            for service, counters in background_stats.snapshot().items():
+                totals = backend.setdefault(('', service), [0, 0, 0, 0.0])
+                for i, value in enumerate(counters):
+                    totals[i] += value
+
+            lines = ['# HELP medic_requests_total HTTP requests handled, by endpoint, method and status.',
+                     '# TYPE medic_requests_total counter']
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append(f'medic_requests_total{{endpoint="{escape_label(endpoint)}",method="{method}",'
+                             f'status="{status}"}} {count}')
+
+            lines += ['# HELP medic_request_duration_seconds Request wall time until the response is returned, by endpoint.',
+                      '# TYPE medic_request_duration_seconds histogram']
+            for endpoint, histogram in sorted(self.latency.items()):
+                label = f'endpoint="{escape_label(endpoint)}"'
+                for bound, count in zip(LATENCY_BUCKETS, histogram):
+                    lines.append(f'medic_request_duration_seconds_bucket{{{label},le="{bound}"}} {count}')
+                lines.append(f'medic_request_duration_seconds_bucket{{{label},le="+Inf"}} {histogram[-1]}')
+                lines.append(f'medic_request_duration_seconds_sum{{{label}}} {histogram[-2]}')
+                lines.append(f'medic_request_duration_seconds_count{{{label}}} {histogram[-1]}')
+
+        # Calls made outside any request (startup, background threads) have an empty endpoint
+        for index, (name, help_text) in enumerate((
+                ('medic_backend_calls_total', 'Firestore, Storage and Auth calls, by endpoint and service.'),
+                ('medic_backend_documents_read_total', 'Firestore documents read, by endpoint.'),
+                ('medic_backend_bytes_total', 'Storage bytes transferred, by endpoint.'),
+                ('medic_backend_seconds_total', 'Time spent waiting on backend calls, by endpoint and service.'))):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            for (endpoint, service), counters in sorted(backend.items()):
+                lines.append(f'{name}{{endpoint="{escape_label(endpoint)}",service="{service}"}} {counters[index]}')
+
+        return '\n'.join(lines) + '\n'
+
+def server_timing(total_seconds, stats):
+    """Build a Server-Timing header value from a request's total time and backend stats."""
+    entries = [f'app;dur={total_seconds * 1000:.1f}']
+    for service, (calls, documents, nbytes, seconds) in sorted(stats.snapshot().items()):
+        entries.append(f'{service};desc="{calls} calls, {documents} docs, {nbytes} B";dur={seconds * 1000:.1f}')
+    return ', '.join(entries)
@@ -0,0 +1,150 @@
+from firebase_admin import firestore
+from google.cloud.firestore_v1 import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
+from firebase_scripts import BATCH_WRITE_LIMIT, initialize_firebase, load_checkpoint, save_checkpoint
+import argparse
+import ast
+import logging
+import timeit
+
+logger = logging.getLogger(__name__)
+
+# Users read per page; each page is checkpointed once its writes are committed
+PAGE_SIZE = 500
+
+def iter_pages(db, role, last_id, page_size):
+    """Yield pages of user documents with the given role, ordered by document ID."""
+    query = (db.collection('users')
+             .where(filter=FieldFilter('role', '==', role))
+             .order_by(FieldPath.document_id())
+             .limit(page_size))
+    while True:
+        page_query = query.start_after({FieldPath.document_id(): last_id}) if last_id else query
+        page = list(page_query.stream())
+        if not page:
+            return
+        yield page
+        last_id = page[-1].id
+
+class WriteBuffer:
+    """Collect document updates and commit them in batches of at most BATCH_WRITE_LIMIT writes."""
+
+    def __init__(self, db, dry_run=False):
+        self.db = db
+        self.dry_run = dry_run
+        self.pending = []
+        self.written = 0
+
+    def update(self, ref, data):
+        self.pending.append((ref, data))
+        if len(self.pending) >= BATCH_WRITE_LIMIT:
+            self.flush()
+
+    def flush(self):
+        if self.pending and not self.dry_run:
+            batch = self.db.batch()
+            for ref, data in self.pending:
+                batch.update(ref, data)
+            batch.commit()
+        self.written += len(self.pending)
+        self.pending = []
+
+def migrate_doctors(db, checkpoint, checkpoint_path, page_size, dry_run):
+    """Convert string 'assigned_patients' fields to arrays and index doctors on their patients."""
+    writes = WriteBuffer(db, dry_run)
+    for page in iter_pages(db, 'doctor', checkpoint['last_id'], page_size):
+        patient_doctors = {}
+        for doctor_doc in page:
+            assigned_patients = doctor_doc.to_dict().get('assigned_patients', [])
+            if isinstance(assigned_patients, str):
+                assigned_patients = ast.literal_eval(assigned_patients)
+                writes.update(doctor_doc.reference, {'assigned_patients': assigned_patients})
+            for patient_id in assigned_patients:
+                patient_doctors.setdefault(patient_id, []).append(doctor_doc.id)
+
+        # Only index patients that still exist; update() fails on missing documents
+        patient_refs = [db.collection('users').document(patient_id) for patient_id in patient_doctors]
+        for patient_doc in db.get_all(patient_refs):
+            if patient_doc.exists:
+                writes.update(patient_doc.reference, {
+                    'assigned_doctors': firestore.ArrayUnion(patient_doctors[patient_doc.id])
+                })
+
+        writes.flush()
+        checkpoint['last_id'] = page[-1].id
+        if not dry_run:
+            save_checkpoint(checkpoint_path, checkpoint)
+        logger.info("Doctors migrated up to %s (%d writes)", checkpoint['last_id'], writes.written)
+
+def migrate_patients(db, checkpoint, checkpoint_path, page_size, dry_run):
+    """Mark every patient's 'assigned_doctors' index as complete, creating an empty one where missing.
+
+    Runs after every doctor has been indexed, so from here on the app can
+    trust 'assigned_doctors' instead of searching the doctors.
+    """
+    writes = WriteBuffer(db, dry_run)
+    for page in iter_pages(db, 'patient', checkpoint['last_id'], page_size):
+        for patient_doc in page:
+            patient_data = patient_doc.to_dict()
+            if patient_data.get('doctors_indexed'):
+                continue
+            update = {'doctors_indexed': True}
+            if 'assigned_doctors' not in patient_data:
+                update['assigned_doctors'] = []
+            writes.update(patient_doc.reference, update)
+
+        writes.flush()
+        checkpoint['last_id'] = page[-1].id
+        if not dry_run:
+            save_checkpoint(checkpoint_path, checkpoint)
+        logger.info("Patients migrated up to %s (%d writes)", checkpoint['last_id'], writes.written)
+
+def migrate(db, checkpoint_path, page_size=PAGE_SIZE, dry_run=False):
+    """Run the migration, resuming from the checkpoint file if one exists.
+
+    ArrayUnion writes are idempotent, so re-running a page after a crash is safe.
+    """
+    checkpoint = load_checkpoint(checkpoint_path, {'phase': 'doctors', 'last_id': None})
+
+    if checkpoint['phase'] == 'doctors':
+        migrate_doctors(db, checkpoint, checkpoint_path, page_size, dry_run)
+        checkpoint = {'phase': 'patients', 'last_id': None}
+        if not dry_run:
+            save_checkpoint(checkpoint_path, checkpoint)
+
+    if checkpoint['phase'] == 'patients':
+        migrate_patients(db, checkpoint, checkpoint_path, page_size, dry_run)
+        checkpoint = {'phase': 'done', 'last_id': None}
+        if not dry_run:
+            save_checkpoint(checkpoint_path, checkpoint)
+
+    logger.info("Migration complete.")
+
+def bench_parse(sizes=(10, 100, 1000, 10000), number=1000):
+    """Compare parsing a Python-repr string against reading a native array."""
+    for size in sizes:
+        patient_ids = [f"patient{i:020d}" for i in range(size)]
+        as_string = str(patient_ids)
+        string_time = timeit.timeit(lambda: patient_ids[0] in ast.literal_eval(as_string), number=number)
+        array_time = timeit.timeit(lambda: patient_ids[0] in list(patient_ids), number=number)
+        print(f"{size:>6} patients: literal_eval {string_time / number * 1e6:10.1f} us, "
+              f"native array {array_time / number * 1e6:8.1f} us")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert 'assigned_patients' strings to native Firestore arrays.")
+    parser.add_argument('--credentials', help="Path to the service account key file")
+    parser.add_argument('--checkpoint', default='migrate_assigned_patients.checkpoint.json',
+                        help="File used to resume an interrupted migration")
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE)
+    parser.add_argument('--dry-run', action='store_true', help="Report the writes without committing them")
+    parser.add_argument('--bench-parse', action='store_true', help="Only run the parse-cost microbenchmark")
+    args = parser.parse_args()
+
+    if args.bench_parse:
+        bench_parse()
+    elif not args.credentials:
+        parser.error("--credentials is required")
+    else:
+        logging.basicConfig(level=logging.INFO, format='%(message)s')
+        _, db = initialize_firebase(args.credentials)
+        migrate(db, args.checkpoint, args.page_size, args.dry_run)
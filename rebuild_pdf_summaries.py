@@ -0,0 +1,79 @@
+from google.cloud.firestore_v1 import FieldFilter
+from firebase_scripts import BATCH_WRITE_LIMIT, initialize_firebase
+from uploads import SUMMARY_RECENT, merge_summary, summary_entry
+import argparse
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Firestore 'in' filters take at most 30 values
+IN_FILTER_LIMIT = 30
+
+def build_summaries(db, patient_ids=None):
+    """Compute patients' PDF summaries from the 'pdfs' collection.
+
+    Covers every patient with at least one PDF, or only those in patient_ids.
+    Only the SUMMARY_RECENT newest entries per patient are kept in memory.
+    """
+    queries = [db.collection('pdfs')]
+    if patient_ids is not None:
+        queries = [db.collection('pdfs').where(filter=FieldFilter('patient_id', 'in', patient_ids[i:i + IN_FILTER_LIMIT]))
+                   for i in range(0, len(patient_ids), IN_FILTER_LIMIT)]
+
+    summaries = {}
+    pending = {}  # patient_id -> entries not folded into the summary yet
+    for query in queries:
+        for doc in query.select(['patient_id', 'pdf_url', 'upload_date']).stream():
+            pdf_data = doc.to_dict()
+            entries = pending.setdefault(pdf_data['patient_id'], [])
+            entries.append(summary_entry(doc.id, pdf_data))
+            if len(entries) >= 4 * SUMMARY_RECENT:
+                summaries[pdf_data['patient_id']] = merge_summary(summaries.get(pdf_data['patient_id']),
+                                                                  pending.pop(pdf_data['patient_id']))
+
+    for patient_id, entries in pending.items():
+        summaries[patient_id] = merge_summary(summaries.get(patient_id), entries)
+    return summaries
+
+def check_summaries(db, patient_ids=None, fix=False):
+    """Compare stored summaries with ones rebuilt from 'pdfs' and, with fix=True, overwrite those that differ.
+
+    Summaries of patients who no longer have any PDFs are deleted. Returns
+    the IDs of the patients whose summaries were wrong.
+    """
+    expected = build_summaries(db, patient_ids)
+    if patient_ids is None:
+        stored = {doc.id: doc.to_dict() for doc in db.collection('pdf_summaries').stream()}
+    else:
+        refs = [db.collection('pdf_summaries').document(patient_id) for patient_id in patient_ids]
+        stored = {doc.id: doc.to_dict() for doc in db.get_all(refs) if doc.exists}
+
+    wrong = sorted(patient_id for patient_id in expected.keys() | stored.keys()
+                   if expected.get(patient_id) != stored.get(patient_id))
+    for patient_id in wrong:
+        logger.info("Summary for patient %s is out of date", patient_id)
+
+    if fix:
+        for i in range(0, len(wrong), BATCH_WRITE_LIMIT):
+            batch = db.batch()
+            for patient_id in wrong[i:i + BATCH_WRITE_LIMIT]:
+                ref = db.collection('pdf_summaries').document(patient_id)
+                if patient_id in expected:
+                    batch.set(ref, expected[patient_id])
+                else:
+                    batch.delete(ref)
+            batch.commit()
+        logger.info("Rebuilt %d summaries.", len(wrong))
+    return wrong
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check per-patient PDF summaries against the 'pdfs' collection.")
+    parser.add_argument('--credentials', required=True, help="Path to the service account key file")
+    parser.add_argument('--patient', action='append', help="Only check this patient UID (may be repeated)")
+    parser.add_argument('--fix', action='store_true', help="Rewrite summaries that are out of date")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    _, db = initialize_firebase(args.credentials)
+    wrong = check_summaries(db, args.patient, args.fix)
+    print(f"{len(wrong)} summaries out of date.")
@@ -1,6 +1,6 @@
 import firebase_admin
 from firebase_admin import credentials, auth, storage, firestore
-import datetime
+from uploads import upload_pdf, save_pdf_metadata
 
 def initialize_firebase():
     """Initialize Firebase Admin SDK for both Authentication and Storage."""
@@ -37,31 +37,15 @@ def upload_file_to_storage(uid, file_path):
         bucket = storage.bucket()
         db = firestore.client()
 
-        # Extract the filename from the provided file path
-        file_name = file_path.split("\\")[-1]
+        # Upload the file to /pdfs/<UID>/<sha256>.pdf and make it public, unless its content is already stored
+        status, pdf_data = upload_pdf(bucket, db, uid, file_path)
+        if status == 'duplicate':
+            print(f"Skipped {file_path}: this report was already uploaded for the patient")
+            return
+        print(f"File {status} to: {pdf_data['pdf_file']}")
 
-        # Set the destination path: /pdfs/<UID>/<file_name>
-        destination_path = f"pdfs/{uid}/{file_name}"
-        blob = bucket.blob(destination_path)
-
-        # Upload the file
-        blob.upload_from_filename(file_path)
-        print(f"File uploaded successfully to: {destination_path}")
-
-        # Make the file publicly accessible
-        blob.make_public()
-
-        # Generate a public URL for the file
-        pdf_url = blob.public_url
-
-        # Update Firestore collection
-        pdf_data = {
-            'patient_id': uid,
-            'pdf_file': destination_path,
-            'pdf_url': pdf_url,
-            'upload_date': datetime.datetime.now()
-        }
-        db.collection('pdfs').add(pdf_data)
+        # Update Firestore collection and the hash index
+        save_pdf_metadata(db, pdf_data)
         print(f"Firestore updated with PDF metadata: {pdf_data}")
 
     except Exception as e:
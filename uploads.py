@@ -0,0 +1,231 @@
+from firebase_admin import firestore
+from google.cloud.firestore_v1 import FieldFilter
+from google.api_core.exceptions import PreconditionFailed
+from concurrent.futures import Future
+import datetime
+import hashlib
+import os
+import threading
+
+# Files larger than this are sent as resumable uploads in RESUMABLE_CHUNK_SIZE
+# pieces, so a dropped connection only re-sends the current chunk.
+# Chunk sizes must be a multiple of 256 KiB.
+RESUMABLE_THRESHOLD = 8 * 1024 * 1024
+RESUMABLE_CHUNK_SIZE = 8 * 1024 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+# Each patient has a summary document, 'pdf_summaries/<patient_id>', holding
+# their report count, latest upload date and SUMMARY_RECENT most recent
+# reports (newest first), so the first dashboard page is a single read. It is
+# updated in the same transaction as the 'pdfs' documents it summarises.
+SUMMARY_RECENT = 20
+
+def pdf_destination_path(uid, sha256):
+    """Return the Storage path for new PDF content: pdfs/<UID>/<sha256>.pdf.
+
+    The name is derived from the content, so the object at a path never
+    changes and a hash index entry always points at the bytes it was
+    created for.
+    """
+    return f"pdfs/{uid}/{sha256}.pdf"
+
+def pdf_file_name(file_path):
+    """Return the name a PDF is downloaded under: its original file name."""
+    # Accept both Windows and POSIX separators in the source path
+    return os.path.basename(file_path.replace("\\", "/"))
+
+def hash_stream(stream):
+    """Return the hex SHA-256 of a binary stream, reading it in HASH_CHUNK_SIZE pieces."""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+def hash_file(file_path):
+    with open(file_path, 'rb') as f:
+        return hash_stream(f)
+
+class UploadClaims:
+    """Content uploaded earlier in one run, whose hash index entries may not be committed yet.
+
+    Bulk ingestion only writes the hash index when it commits a batch of
+    metadata, so the index alone cannot catch copies of the same content
+    within a run. The first file with some content claims its hash; later
+    files wait for its upload and are linked to the same blob.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.claims = {}  # sha256 -> (Future of (pdf_file, pdf_url), set of patient UIDs)
+
+    def claim(self, sha256, uid):
+        """Claim content for a patient. Returns (location future, first claim of the content, patient already claimed it)."""
+        with self.lock:
+            first = sha256 not in self.claims
+            if first:
+                self.claims[sha256] = (Future(), set())
+            location, uids = self.claims[sha256]
+            seen = uid in uids
+            uids.add(uid)
+        return location, first, seen
+
+    def add(self, sha256, uid, pdf_file, pdf_url):
+        """Record content stored before this run whose metadata has not been committed."""
+        location, first, _ = self.claim(sha256, uid)
+        if first:
+            location.set_result((pdf_file, pdf_url))
+
+def pdf_record(uid, pdf_file, pdf_url, sha256, file_name):
+    return {
+        'patient_id': uid,
+        'pdf_file': pdf_file,
+        'pdf_url': pdf_url,
+        'file_name': file_name,
+        'sha256': sha256,
+        'upload_date': datetime.datetime.now()
+    }
+
+def store_pdf(bucket, db, uid, file_path, sha256):
+    """Store a PDF's content unless the hash index already has it. Returns (status, pdf_file, pdf_url)."""
+    existing = db.collection('pdf_hashes').document(sha256).get()
+    if existing.exists:
+        existing_data = existing.to_dict()
+        status = 'duplicate' if uid in existing_data.get('patient_ids', []) else 'linked'
+        return status, existing_data['pdf_file'], existing_data['pdf_url']
+
+    destination_path = pdf_destination_path(uid, sha256)
+    blob = bucket.blob(destination_path)
+    if os.path.getsize(file_path) > RESUMABLE_THRESHOLD:
+        blob.chunk_size = RESUMABLE_CHUNK_SIZE
+
+    # Upload the file and make it publicly accessible. An existing object is never
+    # replaced; one at this path already holds the same content
+    try:
+        blob.upload_from_filename(file_path, content_type='application/pdf', if_generation_match=0)
+    except PreconditionFailed:
+        pass
+    blob.make_public()
+    return 'uploaded', destination_path, blob.public_url
+
+# Uploaded PDFs are indexed by content hash in 'pdf_hashes/<sha256>', which
+# records the blob holding that content and the patients it was uploaded for.
+def upload_pdf(bucket, db, uid, file_path, claims=None):
+    """Upload a PDF to the patient's Storage directory and make it public.
+
+    The file is hashed first and checked against the hash index, so no bytes
+    are sent for content that is already stored. Returns (status, pdf_data):
+    'duplicate' with None if the patient already has this report, 'linked' if
+    another patient's copy of the content is reused, or 'uploaded'. Pass the
+    run's UploadClaims when uploading many files before writing their
+    metadata. Writing the metadata is left to the caller (see
+    pdf_metadata_writes) so that bulk ingestion can batch the writes.
+    """
+    sha256 = hash_file(file_path)
+    file_name = pdf_file_name(file_path)
+    if claims is not None:
+        location, first, seen = claims.claim(sha256, uid)
+        if seen:
+            return 'duplicate', None
+        if not first:
+            return 'linked', pdf_record(uid, *location.result(), sha256, file_name)
+
+    try:
+        status, pdf_file, pdf_url = store_pdf(bucket, db, uid, file_path, sha256)
+    except Exception as e:
+        if claims is not None:
+            location.set_exception(e)
+        raise
+    if claims is not None:
+        location.set_result((pdf_file, pdf_url))
+
+    if status == 'duplicate':
+        return status, None
+    return status, pdf_record(uid, pdf_file, pdf_url, sha256, file_name)
+
+def as_utc(value):
+    # Firestore stores naive datetimes as UTC and returns them timezone-aware
+    return value.replace(tzinfo=datetime.timezone.utc) if value.tzinfo is None else value
+
+def summary_entry(pdf_id, pdf_data):
+    return {'id': pdf_id, 'pdf_url': pdf_data['pdf_url'], 'upload_date': as_utc(pdf_data['upload_date'])}
+
+def merge_summary(summary, entries):
+    """Return a patient's summary (a dict, or None if there is none yet) with new summary entries added."""
+    summary = summary or {'count': 0, 'latest_upload': None, 'recent': []}
+    recent = {entry['id']: entry for entry in summary['recent']}
+    recent.update((entry['id'], entry) for entry in entries)
+    recent = sorted(recent.values(), key=lambda entry: (as_utc(entry['upload_date']), entry['id']), reverse=True)
+    return {
+        'count': summary['count'] + len(entries),
+        'latest_upload': recent[0]['upload_date'] if recent else None,
+        'recent': recent[:SUMMARY_RECENT]
+    }
+
+def build_summary(pdfs):
+    """Build a summary from (pdf_id, pdf_data) pairs, keeping only a few entries in memory at a time."""
+    summary, entries = None, []
+    for pdf_id, pdf_data in pdfs:
+        entries.append(summary_entry(pdf_id, pdf_data))
+        if len(entries) >= 4 * SUMMARY_RECENT:
+            summary, entries = merge_summary(summary, entries), []
+    return merge_summary(summary, entries)
+
+def pdf_metadata_writes(db, pdf_id, pdf_data):
+    """Return the (document_ref, data, merge) writes that record an uploaded PDF.
+
+    These are the 'pdfs' document itself and its entry in the hash index.
+    """
+    return [
+        (db.collection('pdfs').document(pdf_id), pdf_data, False),
+        (db.collection('pdf_hashes').document(pdf_data['sha256']), {
+            'pdf_file': pdf_data['pdf_file'],
+            'pdf_url': pdf_data['pdf_url'],
+            'patient_ids': firestore.ArrayUnion([pdf_data['patient_id']])
+        }, True)
+    ]
+
+@firestore.transactional
+def record_pdfs(transaction, db, pdfs):
+    """Write the metadata for a list of (pdf_id, pdf_data) uploads and update their patients' summaries.
+
+    Everything is written in one transaction, so at most 500 writes: up to
+    two per PDF and one per patient. PDFs whose 'pdfs' document already
+    exists are skipped, so recording the same uploads again (e.g. when
+    resuming after a crash) changes nothing. A patient without a summary yet
+    gets one built from all their 'pdfs' documents, never just the new ones.
+    """
+    pdf_refs = [db.collection('pdfs').document(pdf_id) for pdf_id, _ in pdfs]
+    patient_ids = sorted({pdf_data['patient_id'] for _, pdf_data in pdfs})
+    summary_refs = [db.collection('pdf_summaries').document(patient_id) for patient_id in patient_ids]
+    snapshots = {doc.reference.path: doc for doc in transaction.get_all(pdf_refs + summary_refs)}
+
+    new_pdfs = [(pdf_id, pdf_data) for ref, (pdf_id, pdf_data) in zip(pdf_refs, pdfs) if not snapshots[ref.path].exists]
+    new_entries = {patient_id: [] for patient_id in patient_ids}
+    for pdf_id, pdf_data in new_pdfs:
+        new_entries[pdf_data['patient_id']].append(summary_entry(pdf_id, pdf_data))
+
+    # Every read happens before the first write, as transactions require
+    summaries = {}
+    for ref, patient_id in zip(summary_refs, patient_ids):
+        if not new_entries[patient_id]:
+            continue
+        if snapshots[ref.path].exists:
+            summaries[patient_id] = snapshots[ref.path].to_dict()
+        else:
+            # Reports uploaded before summaries existed must be counted too
+            query = (db.collection('pdfs')
+                     .where(filter=FieldFilter('patient_id', '==', patient_id))
+                     .select(['pdf_url', 'upload_date']))
+            summaries[patient_id] = build_summary((doc.id, doc.to_dict()) for doc in transaction.get(query))
+
+    for pdf_id, pdf_data in new_pdfs:
+        for write_ref, data, merge in pdf_metadata_writes(db, pdf_id, pdf_data):
+            transaction.set(write_ref, data, merge=merge)
+    for ref, patient_id in zip(summary_refs, patient_ids):
+        if patient_id in summaries:
+            transaction.set(ref, merge_summary(summaries[patient_id], new_entries[patient_id]))
+
+def save_pdf_metadata(db, pdf_data):
+    """Write the metadata for a single uploaded PDF. Returns the new 'pdfs' document ID."""
+    pdf_id = db.collection('pdfs').document().id
+    record_pdfs(db.transaction(), db, [(pdf_id, pdf_data)])
+    return pdf_id